@@ -0,0 +1,75 @@
+# encoding=utf-8
+'''
+Measures the latency of cachewrap cache hits, and of building their keys
+with extract_param_by_name on every call as cachewrap used to, against the
+key getters it now resolves when the function is decorated.  The hit path
+cachewrap had before, which built the key with extract_param_by_name, is
+measured alongside it.  Uses the local memory cache backend.
+
+    PYTHONPATH=. python benchmarks/cachewrap_hit.py
+'''
+import timeit
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    import django
+    django.setup()
+
+from visutils.django.cache import (cachewrap, extract_param_by_name, _param_getter,
+                                   _make_cache_key, get_generation, _get_local_generation,
+                                   _cache_get, local_cache, update_latest_data_time)
+
+CALLS = 20000
+
+def fetch(customer, policy, year=2016, lang='is', force=False):
+    return {'customer': customer, 'policy': policy}
+
+KEY_ARGS = ['customer', 'policy', 'year']
+ARGS, KWARGS = ('0101302989', 'P-1234'), {'lang': 'en'}
+GETTERS = [_param_getter(fetch, label) for label in KEY_ARGS]
+GENERATION_GETTER = _param_getter(fetch, 'customer')
+
+def introspected_key():
+    gen = get_generation('customer', extract_param_by_name(fetch, ARGS, KWARGS, 'customer'))
+    params = (extract_param_by_name(fetch, ARGS, KWARGS, label) for label in KEY_ARGS)
+    return _make_cache_key('fetch', params, gen)
+
+def compiled_key():
+    gen = get_generation('customer', GENERATION_GETTER(ARGS, KWARGS))
+    params = [get(ARGS, KWARGS) for get in GETTERS]
+    return _make_cache_key('fetch', params, gen)
+
+cached_fetch = cachewrap(key_args=KEY_ARGS, generation='customer')(fetch)
+local_fetch = cachewrap(key_args=KEY_ARGS, generation='customer', local=True)(fetch)
+
+def introspected_hit(*args, **kwargs):
+    # the hit path of cachewrap before the getters, for the same function
+    gen = get_generation('customer', extract_param_by_name(fetch, args, kwargs, 'customer'))
+    params = [extract_param_by_name(fetch, args, kwargs, label) for label in KEY_ARGS]
+    obj = _cache_get(_make_cache_key('fetch', params, gen))
+    last_updated, value = obj
+    update_latest_data_time(last_updated)
+    return value
+
+def introspected_local_hit(*args, **kwargs):
+    gen = _get_local_generation('customer', extract_param_by_name(fetch, args, kwargs, 'customer'))
+    params = [extract_param_by_name(fetch, args, kwargs, label) for label in KEY_ARGS]
+    obj = local_cache.get(_make_cache_key('fetch', params, gen))
+    last_updated, value = obj
+    update_latest_data_time(last_updated)
+    return value
+
+def best(function):
+    return min(timeit.repeat(function, number=CALLS, repeat=3)) / CALLS * 1e6
+
+if __name__ == '__main__':
+    assert introspected_key() == compiled_key()
+    cached_fetch(*ARGS, **KWARGS)
+    local_fetch(*ARGS, **KWARGS)
+    print 'key with extract_param_by_name:    %.1f us' % best(introspected_key)
+    print 'key with precompiled getters:      %.1f us' % best(compiled_key)
+    print 'hit, extract_param_by_name:        %.1f us' % best(lambda: introspected_hit(*ARGS, **KWARGS))
+    print 'cachewrap hit:                     %.1f us' % best(lambda: cached_fetch(*ARGS, **KWARGS))
+    print 'local hit, extract_param_by_name:  %.1f us' % best(lambda: introspected_local_hit(*ARGS, **KWARGS))
+    print 'cachewrap hit, local=True:         %.1f us' % best(lambda: local_fetch(*ARGS, **KWARGS))
@@ -0,0 +1,61 @@
+# encoding=utf-8
+'''
+Compares sort_list with the previous approach of one cmp=safe_collate sort
+per field, and with selecting only the first page, on 100k rows.
+
+    PYTHONPATH=. python benchmarks/sort_list.py
+'''
+import time
+import random
+import decimal
+from visutils.data.prettifiers import BaseObject
+from visutils.data.sorters import sort_list, safe_collate
+
+ROWS = 100000
+WORDS = [u'Akureyri', u'Álftanes', u'Borgarnes', u'Dalvík', u'Egilsstaðir', u'Ísafjörður',
+         u'Reykjavík', u'Selfoss', u'Þorlákshöfn', u'Ólafsvík', None]
+
+def cmp_sort_list(l, *fields, **kwargs):
+    reverse = kwargs.get('reverse', False)
+    def get_sub_notation(obj, field_notation):
+        ret = obj
+        for f in field_notation.split('.'):
+            if hasattr(ret, f):
+                ret = getattr(ret, f)
+        return ret
+    for f in reversed(fields):
+        l = sorted(l, cmp=safe_collate, key=lambda i: get_sub_notation(i, f), reverse=reverse)
+    return l
+
+def make_rows(n):
+    random.seed(0)
+    rows = []
+    for i in range(n):
+        row = BaseObject()
+        row.name = random.choice(WORDS)
+        row.amount = decimal.Decimal(random.randint(0, 10000)) / 100
+        row.account = BaseObject()
+        row.account.number = random.randint(0, 500)
+        rows.append(row)
+    return rows
+
+def timed(function, *args, **kwargs):
+    best = None
+    for i in range(3):
+        start = time.time()
+        result = function(*args, **kwargs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+if __name__ == '__main__':
+    rows = make_rows(ROWS)
+    fields = ('name', 'account.number', 'amount')
+    for reverse in (False, True):
+        old, expected = timed(cmp_sort_list, rows, *fields, reverse=reverse)
+        new, result = timed(sort_list, rows, *fields, reverse=reverse)
+        assert [id(r) for r in expected] == [id(r) for r in result]
+        print '%d rows, reverse=%s: cmp %.3fs, key %.3fs (%.1fx)' % (ROWS, reverse, old, new, old / new)
+        page, first = timed(sort_list, rows, *fields, reverse=reverse, limit=25)
+        assert [id(r) for r in expected[:25]] == [id(r) for r in first]
+        print '%d rows, reverse=%s, limit=25: %.3fs' % (ROWS, reverse, page)
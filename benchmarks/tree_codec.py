@@ -0,0 +1,73 @@
+# encoding=utf-8
+'''
+Compares the size and the decoding time of visutils.data.codec against
+pickle, and against the size of the pickle compressed as cachewrap does
+it, for a response parsed by xml2struct and parse_native_types, as dicts
+and as objectify_tree objects.
+
+    PYTHONPATH=. python benchmarks/tree_codec.py
+'''
+import cPickle as pickle
+import random
+import timeit
+import zlib
+from visutils.data import codec
+from visutils.data import prettifiers as p
+from visutils.data.prettifiers import objectify_tree
+from visutils.data.transform import xml2struct
+
+RECORDS = 2000
+PRETTIFIERS = [p.embed_at_tags, p.embed_hash_tags, p.collapse_singleton_dict_strings, p.parse_native_types]
+
+RECORD = u"""<Policy id="%(id)d">
+  <policyNumber>P-%(number)08d</policyNumber>
+  <owner><ssn>%(ssn)010d</ssn><name>%(name)s</name></owner>
+  <premium>%(premium)d.%(cents)02d</premium>
+  <paid>%(paid)d.%(cents)02d</paid>
+  <count>%(count)d</count>
+  <validFrom>%(day)02d.%(month)02d.2016</validFrom>
+  <validTo>%(day)02d.%(month)02d.2017 12:00</validTo>
+  <address><street>Laugavegur %(street)d</street><postcode>101</postcode><town>Reykjavík</town></address>
+  %(coverages)s
+</Policy>"""
+
+def make_records():
+    '''
+    Returns a response of RECORDS policies as xml2struct and the usual
+    prettifiers make it, with unicode keys.
+    '''
+    rand = random.Random(0)
+    records = []
+    for i in range(RECORDS):
+        coverages = u''.join(u'<cover code="K%d"><amount>%d</amount></cover>' % (j, rand.randint(0, 10**5))
+                             for j in range(rand.randint(1, 3)))
+        records.append(RECORD % {
+            'id': i, 'number': rand.randint(0, 10**8), 'ssn': rand.randint(0, 10**10),
+            'name': rand.choice([u'Jón Jónsson', u'Guðrún Ólafsdóttir', u'Þórður Ævarsson']),
+            'premium': rand.randint(0, 10**6), 'paid': rand.randint(0, 10**6), 'cents': rand.randint(0, 99),
+            'count': rand.randint(0, 100), 'day': rand.randint(1, 28), 'month': rand.randint(1, 12),
+            'street': rand.randint(1, 200), 'coverages': coverages,
+        })
+    src = u'<Policies>%s</Policies>' % u''.join(records)
+    return xml2struct(src.encode('utf-8'), prettifiers=PRETTIFIERS)
+
+def best(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e3
+
+def compare(name, tree):
+    pickled = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+    encoded = codec.dumps(tree)
+    print name
+    print '  size         pickle %8d  codec %8d  (%.0f%%)' % (len(pickled), len(encoded),
+                                                             100.0 * len(encoded) / len(pickled))
+    print '  compressed   pickle %8d' % len(zlib.compress(pickled))
+    print '  loads ms     pickle %8.1f  codec %8.1f' % (best(lambda: pickle.loads(pickled), 10),
+                                                        best(lambda: codec.loads(encoded), 10))
+    print '  dumps ms     pickle %8.1f  codec %8.1f' % (best(lambda: pickle.dumps(tree, pickle.HIGHEST_PROTOCOL), 10),
+                                                        best(lambda: codec.dumps(tree), 10))
+
+if __name__ == '__main__':
+    tree = make_records()
+    compare('dicts', tree)
+    compare('objectify_tree', objectify_tree(tree))
+    compare('objectify_tree(slots=True)', objectify_tree(tree, slots=True))
@@ -0,0 +1,79 @@
+import os
+import unittest
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DEBUG_CACHE=True,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    )
+    import django
+    django.setup()
+
+from visutils.django import cache
+
+
+class DebugCacheTest(unittest.TestCase):
+    '''
+    cachewrap with DEBUG_CACHE on, where the cache calls are logged.
+    '''
+    def setUp(self):
+        self._cache = cache.cache
+        cache.cache = cache.debug_cache()
+        cache.cache.clear()
+        self.calls = []
+
+    def tearDown(self):
+        cache.cache = self._cache
+
+    def test_ignored(self):
+        self.assertTrue(cache.debug_cache.ignored('to_slug.1'))
+        self.assertFalse(cache.debug_cache.ignored('fetch.1'))
+        self.assertTrue(cache.debug_cache.ignored(['to_slug.1', 'repodownloadsize.2']))
+        self.assertFalse(cache.debug_cache.ignored({'to_slug.1': 1, 'fetch.1': 2}))
+
+    def test_many(self):
+        @cache.cachewrap(key_args=['n'])
+        def fetch(n):
+            self.calls.append(n)
+            return n * 2
+        self.assertEqual(fetch.many([(1,), (2,)]), [2, 4])
+        self.assertEqual(fetch.many([(1,), (2,), (3,)]), [2, 4, 6])
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_generations(self):
+        @cache.cachewrap(key_args=['a', 'b'], generation=['a', 'b'])
+        def fetch(a, b):
+            self.calls.append((a, b))
+            return a + b
+        self.assertEqual(fetch(1, 2), 3)
+        self.assertEqual(fetch(1, 2), 3)
+        self.assertEqual(self.calls, [(1, 2)])
+
+    def test_chunked(self):
+        # over ITEM_LIMIT when compressed, so stored and read with set_many
+        # and get_many
+        value = os.urandom(cache.ITEM_LIMIT * 2)
+        @cache.cachewrap(key_args=['n'])
+        def fetch(n):
+            self.calls.append(n)
+            return value
+        key = cache._make_cache_key('fetch', [1])
+        self.assertEqual(fetch(1), value)
+        self.assertTrue(isinstance(cache.cache.get(key)[1], cache._Chunked))
+        self.assertEqual(fetch(1), value)
+        self.assertEqual(self.calls, [1])
+
+    def test_invalidate(self):
+        @cache.cachewrap(key_args=['a', 'b'], generation=['a', 'b'])
+        def fetch(a, b):
+            self.calls.append((a, b))
+            return a + b
+        fetch(1, 2)
+        cache.increment_generations([('a', 1), ('b', 2)])
+        fetch(1, 2)
+        self.assertEqual(self.calls, [(1, 2), (1, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
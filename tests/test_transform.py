@@ -0,0 +1,19 @@
+import unittest
+from visutils.data.transform import iter_xml_records
+
+
+class IterXmlRecordsTest(unittest.TestCase):
+    def test_records(self):
+        src = '<r><p id="1">a</p><!-- c --><p id="2">b</p></r>'
+        records = list(iter_xml_records(src, 'r/p'))
+        self.assertEqual([p['@id'] for p in records], [u'1', u'2'])
+
+    def test_root_record_after_comment(self):
+        src = '<!-- c --><?pi x?><r><p>a</p></r>'
+        records = list(iter_xml_records(src, 'r'))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['p'], {u'#text': u'a'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+# encoding=utf-8
+'''
+A compact serialization for the trees xml2struct and objectify_tree make,
+for use as a cachewrap serializer in place of pickle.
+
+The tree is rewritten into values marshal can write, which it then writes
+in C.  Dict keys and attribute names in str are interned, so marshal
+writes each of them once per payload and refers back to it after that.
+Marshal doesn't do that for unicode, so the keys of dicts with unicode
+keys, as xml2struct makes them, are kept in a table of key tuples that
+each dict refers to by index.  Decimals are
+kept as (sign, digits, exponent) and rebuilt without parsing them, and
+dates and naive datetimes as the byte strings datetime pickles to, with
+the tzinfo of aware datetimes pickled once per payload.  BaseObjects are
+rebuilt by filling in their __dict__, or their slots for the classes of
+objectify_tree(slots=True), without going through __setattr__.
+
+Dicts, lists and leaves that marshal can write as they are stay as they
+are, so that loads only walks the parts of the tree that hold anything
+else, and lists, slots and dicts with unicode keys carry the positions of
+the values loads has to decode.  Values of other types are pickled one by one.  Objects that appear
+more than once in the tree are written, and read back, once for each time.
+
+Marshal writes lengths and numbers in full, so the payload is compressed
+with the fastest zlib level, which makes it a fraction of the size of the
+pickle at a small cost to loads.
+'''
+import cPickle as pickle
+import datetime
+import decimal
+import marshal
+import zlib
+from itertools import izip
+from visutils.data.prettifiers import BaseObject, LazyObject, _ShapedObject, _shape, _make_shaped_object
+
+_MAGIC = 'visutils.codec.2'
+# tells cachewrap that payloads are compressed already
+COMPRESSED = True
+
+# tags of the tuples values that marshal can't write are replaced with
+_PICKLED, _DECIMAL, _DECIMAL_TEXT, _DATETIME, _DATE, _DICT, _ITEMS, _LIST, _TUPLE, \
+    _OBJECT, _SHAPED, _LAZY, _KEYED = range(13)
+
+_PLAIN = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+try:
+    _dec_from_triple = decimal._dec_from_triple
+except AttributeError:
+    def _dec_from_triple(sign, digits, exponent):
+        return decimal.Decimal((sign, map(int, digits), exponent))
+
+def _intern(name):
+    # slot names are ASCII, but come in unicode from xml2struct trees
+    if type(name) is unicode:
+        name = name.encode('ascii')
+    return intern(name)
+
+class _Encoder(object):
+    def __init__(self):
+        self.shapes = []
+        self._shape_index = {}
+        self.keys = []
+        self._keys_index = {}
+        self.tzinfos = []
+        self._tzinfo_index = {}
+
+    def encode(self, value):
+        '''
+        Returns (encoded, plain), where plain is True when the value is
+        written as it is.
+        '''
+        kind = type(value)
+        if kind in _PLAIN:
+            return value, True
+        if kind is dict:
+            return self._dict(value)
+        if kind is list:
+            items, fixes = self._items(value)
+            return (items, True) if not fixes else ((_LIST, items, fixes), False)
+        if kind is decimal.Decimal:
+            sign, digits, exponent = value.as_tuple()
+            if isinstance(exponent, (int, long)):
+                return (_DECIMAL, sign, ''.join(map(str, digits)), exponent), False
+            return (_DECIMAL_TEXT, str(value)), False
+        if kind is datetime.datetime:
+            state = value.__reduce__()[1][0]
+            if value.tzinfo is None:
+                return (_DATETIME, state), False
+            return (_DATETIME, state, self._tzinfo(value.tzinfo)), False
+        if kind is datetime.date:
+            return (_DATE, value.__reduce__()[1][0]), False
+        if kind is tuple:
+            return (_TUPLE, self._items(value)[0]), False
+        if kind is BaseObject:
+            return (_OBJECT, self.encode(value.__dict__)[0]), False
+        if isinstance(value, _ShapedObject):
+            values, fixes = self._items([getattr(value, name) for name in value.__slots__])
+            extra = self.encode(value.__dict__)[0] if value.__dict__ else None
+            return (_SHAPED, self._shape(value.__slots__), values, fixes, extra), False
+        if kind is LazyObject:
+            # attributes read from the dict are left out, they are read again
+            sources = value._get_sources() if value._sources is None else value._sources
+            extra = dict((name, attr) for name, attr in value.__dict__.iteritems() if name not in sources)
+            return (_LAZY, self.encode(value._tree)[0], self.encode(value._collations)[0],
+                    value._parent, self.encode(extra)[0]), False
+        return (_PICKLED, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), False
+
+    def _items(self, values):
+        '''
+        Returns (items, fixes), where fixes are the positions of the items
+        that loads has to decode.
+        '''
+        items, fixes = [], []
+        for value in values:
+            value, plain = self.encode(value)
+            if not plain:
+                fixes.append(len(items))
+            items.append(value)
+        return items, fixes
+
+    def _dict(self, tree):
+        keys, values, fixes, unicode_keys = [], [], [], 0
+        for key, value in tree.iteritems():
+            kind = type(key)
+            if kind is str:
+                key = intern(key)
+            elif kind is unicode:
+                unicode_keys += 1
+            elif kind not in _PLAIN:
+                return (_ITEMS, self._items(tree.iterkeys())[0], self._items(tree.itervalues())[0]), False
+            value, plain = self.encode(value)
+            if not plain:
+                fixes.append(len(values))
+            keys.append(key)
+            values.append(value)
+        if unicode_keys and unicode_keys == len(keys):
+            return (_KEYED, self._keys(tuple(keys)), values, fixes), False
+        ret = dict(izip(keys, values))
+        return (ret, True) if not fixes else ((_DICT, ret), False)
+
+    def _keys(self, keys):
+        index = self._keys_index.get(keys)
+        if index is None:
+            index = self._keys_index[keys] = len(self.keys)
+            self.keys.append(keys)
+        return index
+
+    def _shape(self, names):
+        index = self._shape_index.get(names)
+        if index is None:
+            index = self._shape_index[names] = len(self.shapes)
+            self.shapes.append(tuple(_intern(name) for name in names))
+        return index
+
+    def _tzinfo(self, tzinfo):
+        index = self._tzinfo_index.get(id(tzinfo))
+        if index is None:
+            index = self._tzinfo_index[id(tzinfo)] = len(self.tzinfos)
+            self.tzinfos.append(tzinfo)
+        return index
+
+def dumps(value):
+    '''
+    Returns value serialized as a string.
+    '''
+    encoder = _Encoder()
+    body = encoder.encode(value)[0]
+    tzinfos = pickle.dumps(encoder.tzinfos, pickle.HIGHEST_PROTOCOL) if encoder.tzinfos else None
+    return zlib.compress(marshal.dumps((_MAGIC, encoder.shapes, encoder.keys, tzinfos, body), 2), 1)
+
+def loads(data):
+    '''
+    Returns the value dumps serialized to data.  Raises ValueError for data
+    that dumps didn't make.
+    '''
+    try:
+        magic, shapes, keys, tzinfos, body = marshal.loads(zlib.decompress(data))
+    except (zlib.error, EOFError, TypeError, ValueError):
+        raise ValueError('Not a codec payload')
+    if magic != _MAGIC:
+        raise ValueError('Not a codec payload')
+    tzinfos = pickle.loads(tzinfos) if tzinfos is not None else ()
+    classes = [(names, _shape(names)) for names in shapes]
+    new_object = BaseObject.__new__
+    new_datetime = datetime.datetime
+    set_dict = object.__setattr__
+
+    def decode_items(items):
+        for i, item in enumerate(items):
+            if type(item) is tuple:
+                items[i] = decode(item)
+        return items
+
+    def decode_fixes(items, fixes):
+        for i in fixes:
+            items[i] = decode(items[i])
+        return items
+
+    def decode(node):
+        tag = node[0]
+        if tag == _KEYED:
+            return dict(izip(keys[node[1]], decode_fixes(node[2], node[3])))
+        if tag == _DECIMAL:
+            return _dec_from_triple(node[1], node[2], node[3])
+        if tag == _DATETIME:
+            if len(node) == 2:
+                return new_datetime(node[1])
+            return new_datetime(node[1], tzinfos[node[2]])
+        if tag == _LIST:
+            return decode_fixes(node[1], node[2])
+        if tag == _SHAPED:
+            names, shape = classes[node[1]]
+            values = decode_fixes(node[2], node[3])
+            extra = node[4]
+            if type(extra) is tuple:
+                extra = decode(extra)
+            if shape is None:
+                return _make_shaped_object(names, values, extra)
+            cls, setters = shape
+            ret = cls.__new__(cls)
+            for setter, value in izip(setters, values):
+                setter(ret, value)
+            if extra:
+                ret.__dict__.update(extra)
+            return ret
+        if tag == _OBJECT:
+            attrs = node[1]
+            if type(attrs) is tuple:
+                attrs = decode(attrs)
+            ret = new_object(BaseObject)
+            set_dict(ret, '__dict__', attrs)
+            return ret
+        if tag == _DICT:
+            tree = node[1]
+            for key, value in tree.iteritems():
+                if type(value) is tuple:
+                    tree[key] = decode(value)
+            return tree
+        if tag == _DATE:
+            return datetime.date(node[1])
+        if tag == _DECIMAL_TEXT:
+            return decimal.Decimal(node[1])
+        if tag == _TUPLE:
+            return tuple(decode_items(node[1]))
+        if tag == _ITEMS:
+            return dict(izip(decode_items(node[1]), decode_items(node[2])))
+        if tag == _LAZY:
+            tree, collations, parent, extra = [decode(i) if type(i) is tuple else i for i in node[1:]]
+            ret = LazyObject(tree, collations=collations, parent=parent)
+            ret.__dict__.update(extra)
+            return ret
+        if tag == _PICKLED:
+            return pickle.loads(node[1])
+        raise ValueError('Unknown tag %r' % (tag,))
+
+    return decode(body) if type(body) is tuple else body
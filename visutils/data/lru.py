@@ -0,0 +1,44 @@
+# encoding=utf-8
+
+class LRUCache(object):
+    '''
+    A small bounded cache that keeps the most recently used entries.
+
+    Entries are kept in two plain dicts.  New and recently read entries go
+    into the young one, and once it holds maxsize/2 entries it replaces the
+    old one, dropping whatever wasn't used since.  This approximates least
+    recently used eviction with only dict operations, so lookups are cheap
+    and safe to share between threads.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._young, self._old = {}, {}
+
+    def get(self, key, default=None):
+        try:
+            return self._young[key]
+        except KeyError:
+            pass
+        try:
+            value = self._old[key]
+        except KeyError:
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        young = self._young
+        if len(young) >= self.maxsize // 2:
+            self._old, self._young = young, {}
+            young = self._young
+        young[key] = value
+
+    def delete(self, key):
+        self._young.pop(key, None)
+        self._old.pop(key, None)
+
+    def clear(self):
+        self._young, self._old = {}, {}
+
+    def __contains__(self, key):
+        return key in self._young or key in self._old
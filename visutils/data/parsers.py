@@ -1,7 +1,9 @@
 # encoding=utf-8
+import re
 import datetime
 from dateutil import parser
 from iso8601 import parse_date
+from visutils.data.lru import LRUCache
 #
 # Boolean
 #
@@ -25,31 +27,84 @@ def skip_parsing(value):
 
 NULL_DATES = ('0001-01-01', '0001-01-01T00:00:00')
 
+# Marks a cached result where the parser gave back the object it was passed.
+_UNPARSED = object()
+_MISSING = object()
+
+# The common ISO shapes, parsed without going through iso8601, with
+# whatever tzinfo it gives naive and 'Z' times.
+_ISO_DATETIME_RE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})(?:[T ]([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?Z?)?\Z')
+_ISO_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})\Z')
+_SAP_DATE_RE = re.compile(r'([0-9]{2})([0-9]{2})([0-9]{4})\Z')
+_ISO_UTC = parse_date('2000-01-01').tzinfo
+
 def parse_epoch_datetime(time_value):
     if time_value == '0':
         return None
     return datetime.datetime.fromtimestamp(float(time_value) / 1000)
 
 
-def parse_iso_datetime(obj):
-    # todo - find a slightly more tolerant way to parse iso dates or force all the implementors to get it right
-    date_formats = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f+00:00', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT:%H:%M:%S',
-                    '%Y-%m-%dT%H:%M:%S','%Y-%m-%d']
+_iso_datetime_cache = LRUCache(4096)
+_iso_datetime_formats = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f+00:00', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT:%H:%M:%S',
+                         '%Y-%m-%dT%H:%M:%S','%Y-%m-%d']
+_last_iso_datetime_format = [None]
 
+def parse_iso_datetime(obj):
     date_string = str(obj)
     if date_string in NULL_DATES:
         return
 
+    date = _iso_datetime_cache.get(date_string, _MISSING)
+    if date is _MISSING:
+        date = _fast_iso_datetime(date_string)
+        if date is None:
+            date, cacheable = _parse_iso_datetime(date_string, obj)
+            if date is obj:
+                date = _UNPARSED
+        else:
+            cacheable = True
+        if cacheable:
+            _iso_datetime_cache.set(date_string, date)
+    if date is _UNPARSED:
+        return obj
+    return date
+
+def _fast_iso_datetime(date_string):
+    match = _ISO_DATETIME_RE.match(date_string)
+    if match is None:
+        return
+    year, month, day, hour, minute, second, fraction = match.groups()
     try:
-        return parse_date(date_string)
+        if hour is None:
+            return datetime.datetime(int(year), int(month), int(day), tzinfo=_ISO_UTC)
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                 int(fraction.ljust(6, '0')) if fraction else 0, _ISO_UTC)
+    except ValueError:
+        return
+
+def _parse_iso_datetime(date_string, obj):
+    """
+    Returns the parsed date and whether it can be cached.  dateutil fills in
+    missing parts of a date from today's date, so its results are not.
+    """
+    # todo - find a slightly more tolerant way to parse iso dates or force all the implementors to get it right
+    try:
+        return parse_date(date_string), True
     except:
         pass
 
     try:
-        return parser.parse(date_string)
+        return parser.parse(date_string), False
     except:
         pass
 
+    # no string matches more than one of the formats, so the one that matched
+    # last time can safely be tried first
+    last_format = _last_iso_datetime_format[0]
+    date_formats = _iso_datetime_formats
+    if last_format is not None:
+        date_formats = [last_format] + date_formats
     for date_format in date_formats:
         # repeatedly try matching with different date formats, exiting as soon as one matches
         try:
@@ -57,49 +112,119 @@ def parse_iso_datetime(obj):
         except:
             continue
         else:
+            _last_iso_datetime_format[0] = date_format
             break
     else:
         date = obj
 
     # The null date has year 1.
     if getattr(date, 'year', None) == 1:
-        return None
+        return None, True
 
-    return date
+    return date, True
 
 
+def _fast_iso_date(date_string):
+    match = _ISO_DATE_RE.match(date_string)
+    if match is None:
+        return
+    year, month, day = match.groups()
+    try:
+        return datetime.datetime(int(year), int(month), int(day))
+    except ValueError:
+        return
+
 def parse_iso_date(obj):
     date_string = str(obj)
     try:
         if date_string in NULL_DATES:
             return
         else:
-            return datetime.datetime.strptime(date_string, '%Y-%m-%d')
+            return _fast_iso_date(date_string) or datetime.datetime.strptime(date_string, '%Y-%m-%d')
     except:
         return obj
 
 
+def _format_short_date(date):
+    # the same as date.strftime("%d.%m.%y"), which refuses years before 1900
+    if date.year < 1900:
+        raise ValueError("year=%d is before 1900" % date.year)
+    return '%02d.%02d.%02d' % (date.day, date.month, date.year % 100)
+
+_iso_date2str_cache = LRUCache(4096)
+
 def parse_iso_date2str(obj):
     date_string = str(obj)
     if date_string in NULL_DATES:
         return
-    try:
-        return datetime.datetime.strptime(date_string, '%Y-%m-%d').strftime("%d.%m.%y")
-    except:
+    ret = _iso_date2str_cache.get(date_string)
+    if ret is None:
+        try:
+            date = _fast_iso_date(date_string) or datetime.datetime.strptime(date_string, '%Y-%m-%d')
+            ret = _format_short_date(date)
+        except:
+            ret = _UNPARSED
+        _iso_date2str_cache.set(date_string, ret)
+    if ret is _UNPARSED:
         return obj
+    return ret
+
+
+def _parse_sap_date(date_string):
+    match = _SAP_DATE_RE.match(date_string)
+    if match is not None:
+        day, month, year = match.groups()
+        try:
+            return datetime.datetime(int(year), int(month), int(day))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(date_string, '%d%m%Y')
 
+_sap_period_cache = LRUCache(4096)
 
 def format_sap_period(value):
     try:
-        strDates = str(value).split('-')
-        if len(strDates) == 2:
-            newDate = datetime.datetime.strptime(strDates[0], '%d%m%Y').strftime("%d.%m.%y")
-            newDate = newDate + ' - ' + datetime.datetime.strptime(strDates[1], '%d%m%Y').strftime("%d.%m.%y")
-            return newDate
-        else:
-            return value
+        period = str(value)
     except:
         return value
+    ret = _sap_period_cache.get(period)
+    if ret is None:
+        try:
+            strDates = period.split('-')
+            if len(strDates) == 2:
+                newDate = _format_short_date(_parse_sap_date(strDates[0]))
+                ret = newDate + ' - ' + _format_short_date(_parse_sap_date(strDates[1]))
+            else:
+                ret = _UNPARSED
+        except:
+            ret = _UNPARSED
+        _sap_period_cache.set(period, ret)
+    if ret is _UNPARSED:
+        return value
+    return ret
+
+
+def parse_dates(values, parse=parse_iso_datetime):
+    """
+    Parses a whole column of values with one of the date parsers above,
+    parsing each distinct value only once.
+
+    >>> parse_dates(['2003-02-01', '2003-02-01', 'foo'], parse_iso_date2str)
+    ['01.02.03', '01.02.03', 'foo']
+    """
+    parsed = {}
+    ret = []
+    for value in values:
+        try:
+            date = parsed[value]
+        except KeyError:
+            date = parse(value)
+            parsed[value] = _UNPARSED if date is value else date
+        except TypeError:
+            # not hashable
+            date = parse(value)
+        ret.append(value if date is _UNPARSED else date)
+    return ret
 
 
 def remove_xml_version(src):
@@ -0,0 +1,255 @@
+# encoding=utf-8
+import decimal
+import datetime
+from functools import partial
+from visutils.data import prettifiers as p
+
+#
+# Single node steps
+#
+# Each step does the work of one prettifier on one dict or list without
+# recursing.  The walk then descends into every dict and list left in the
+# node, so a step only returns the children that its prettifier would not
+# have recursed into, as (child, stages to clear) pairs, or None.
+#
+
+_SEQ = (dict, list)
+
+def _strip_xmlns_step(only_empty=False):
+    def step(tree, bit):
+        if isinstance(tree, dict):
+            for key, value in tree.items():
+                if isinstance(value, _SEQ):
+                    continue
+                elif value is None:
+                    del tree[key]
+                elif key == 'xmlns' and (not only_empty or len(value) == 0):
+                    del tree[key]
+    return step
+
+def _embed_tags_step(tag):
+    def step(tree, bit):
+        skipped = None
+        if isinstance(tree, dict):
+            marked = []
+            for key, value in tree.items():
+                _key = unicode(key)
+                if _key.startswith(tag):
+                    _key = _key.lstrip(tag)
+                    if _key not in tree:
+                        tree[_key] = value
+                        marked.append(key)
+                    elif isinstance(value, _SEQ) and value is not tree[_key]:
+                        # the prettifier recurses into tree[_key] instead
+                        skipped = skipped or []
+                        skipped.append((value, bit))
+            for key in marked:
+                del tree[key]
+        return skipped
+    return step
+
+def _collapse_singleton_dict_strings_step():
+    def step(tree, bit):
+        if isinstance(tree, dict):
+            for key, value in tree.items():
+                if isinstance(value, dict) and len(value) == 1:
+                    for _value in value.values():
+                        if isinstance(_value, basestring):
+                            tree[key] = _value
+        elif isinstance(tree, list):
+            for i, item in enumerate(tree):
+                if isinstance(item, dict) and len(item) == 1:
+                    for _value in item.values():
+                        if isinstance(_value, basestring):
+                            tree[i] = unicode(_value)
+    return step
+
+def _collapse_singleton_list_strings_step():
+    def step(tree, bit):
+        skipped = None
+        if isinstance(tree, dict):
+            items = tree.items()
+        elif isinstance(tree, list):
+            items = enumerate(tree)
+        else:
+            return
+        for key, value in items:
+            if isinstance(value, list) and len(value) == 1:
+                tree[key] = value[0]
+                if isinstance(value[0], _SEQ):
+                    skipped = skipped or []
+                    skipped.append((value[0], bit))
+        return skipped
+    return step
+
+def _convert_empty_dict_to_string_step():
+    def step(tree, bit):
+        if isinstance(tree, dict):
+            items = tree.items()
+        elif isinstance(tree, list):
+            items = enumerate(tree)
+        else:
+            return
+        for key, value in items:
+            if isinstance(value, dict) and len(value) == 0:
+                tree[key] = ''
+    return step
+
+def _parse_native_types_step(types=list(), functions=dict(), plan=None):
+    if plan is None:
+        plan = _NativeTypes(types, functions)
+    parse = plan.parse
+    def step(tree, bit):
+        skipped = None
+        if isinstance(tree, dict):
+            for key, value in tree.items():
+                if key in p.SKIP_KEYS:
+                    if isinstance(value, _SEQ):
+                        skipped = skipped or []
+                        skipped.append((value, bit))
+                    continue
+                if type(value) in p._SEQ_TYPES:
+                    continue
+                tree[key] = parse(value, key)
+                if isinstance(tree[key], _SEQ):
+                    skipped = skipped or []
+                    skipped.append(_parsed_seq(tree[key], value, bit))
+        elif isinstance(tree, list):
+            for i, item in enumerate(tree):
+                if type(item) in p._SEQ_TYPES:
+                    continue
+                tree[i] = parse(item)
+                if isinstance(tree[i], _SEQ):
+                    skipped = skipped or []
+                    skipped.append(_parsed_seq(tree[i], item, bit))
+        return skipped
+    return step
+
+class _NativeTypes(object):
+    # the leaf conversion of parse_native_types, as NativeTypePlan.parse
+    def __init__(self, types, functions):
+        if not len(types):
+            types = [long, int, decimal.Decimal, datetime.datetime]
+        self.types = types
+        self.functions = functions
+
+    def parse(self, value, key=None):
+        if key is not None and key in self.functions:
+            return p._parse_native_type(value, function=self.functions[key])
+        return p._parse_native_type(value, types=self.types)
+
+def _parsed_seq(parsed, value, bit):
+    # parse_native_types doesn't recurse into values it parsed, and the
+    # prettifiers before it never saw a dict or list that it created
+    if parsed is value:
+        return parsed, bit
+    return parsed, (bit << 1) - 1
+
+# What a step reads from the children of the node it works on, and what it
+# changes in the node itself.  'size' is the number of keys in a dict and
+# 'values' the objects held by a dict or list.  'subtrees' is read by steps
+# that lift grandchildren up a level and is changed by every step.  A step
+# can only share a walk with the steps before it if it doesn't read what
+# they change, as it would otherwise see children that the earlier
+# prettifiers haven't reached yet.
+_STEPS = {
+    p.strip_xmlns: (partial(_strip_xmlns_step, only_empty=False), (), ('size',)),
+    p.strip_empty_xmlns: (partial(_strip_xmlns_step, only_empty=True), (), ('size',)),
+    p.embed_hash_tags: (partial(_embed_tags_step, '#'), (), ()),
+    p.embed_at_tags: (partial(_embed_tags_step, '@'), (), ()),
+    p.collapse_singleton_dict_strings: (_collapse_singleton_dict_strings_step, ('size', 'values'), ('values',)),
+    p.collapse_singleton_list_strings: (_collapse_singleton_list_strings_step, ('values', 'subtrees'), ('values',)),
+    p.convert_empty_dict_to_string: (_convert_empty_dict_to_string_step, ('size',), ('values',)),
+    p.parse_native_types: (_parse_native_types_step, (), ('values',)),
+}
+
+def _lookup_step(prettifier):
+    '''
+    Returns (step, reads, writes) for a known prettifier, or None.
+    functools.partial objects of known prettifiers are supported so that
+    e.g. parse_native_types can be given its functions.
+    '''
+    args, kwargs = (), {}
+    if isinstance(prettifier, partial):
+        args, kwargs = prettifier.args, prettifier.keywords or {}
+        prettifier = prettifier.func
+    if isinstance(prettifier, p.NativeTypePlan):
+        return _parse_native_types_step(plan=prettifier), (), ('values',)
+    try:
+        factory, reads, writes = _STEPS[prettifier]
+    except (KeyError, TypeError):
+        return None
+    return factory(*args, **kwargs), reads, writes
+
+
+def _fused_walk(steps):
+    # the stages that still have to visit a node are kept as a bit mask
+    stages = [(step, 1 << i) for i, step in enumerate(steps)]
+    def walk(tree):
+        stack = [(tree, (1 << len(stages)) - 1)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            node, mask = pop()
+            cleared = None
+            for step, bit in stages:
+                if mask & bit:
+                    skipped = step(node, bit)
+                    if skipped:
+                        cleared = cleared or {}
+                        for child, bits in skipped:
+                            cleared[id(child)] = cleared.get(id(child), 0) | bits
+            if isinstance(node, dict):
+                children = node.itervalues()
+            elif isinstance(node, list):
+                children = node
+            else:
+                continue
+            if cleared is None:
+                for child in children:
+                    if isinstance(child, _SEQ):
+                        push((child, mask))
+            else:
+                for child in children:
+                    if isinstance(child, _SEQ):
+                        child_mask = mask & ~cleared.get(id(child), 0)
+                        if child_mask:
+                            push((child, child_mask))
+        return tree
+    return walk
+
+def compile_prettifiers(prettifiers):
+    '''
+    Compiles a list of prettifiers into a single function that gives the
+    same result as applying them one after the other, as xml2struct does.
+    Consecutive prettifiers from visutils.data.prettifiers are fused into
+    one iterative walk of the tree, so the cost is not multiplied by the
+    number of prettifiers and deeply nested trees don't hit the recursion
+    limit.  A new walk is only started where a prettifier depends on the
+    children having been fully processed by an earlier one, e.g.
+    collapse_singleton_list_strings after strip_xmlns.  Other callables,
+    such as objectify_tree, are called as they are.
+    '''
+    passes, steps, written = [], [], set()
+    for prettifier in prettifiers:
+        found = _lookup_step(prettifier)
+        if found is not None:
+            step, reads, writes = found
+            if steps and written.intersection(reads):
+                passes.append(_fused_walk(steps))
+                steps, written = [], set()
+            steps.append(step)
+            written.update(writes)
+            written.add('subtrees')
+        else:
+            if steps:
+                passes.append(_fused_walk(steps))
+                steps, written = [], set()
+            passes.append(prettifier)
+    if steps:
+        passes.append(_fused_walk(steps))
+
+    def pipeline(tree):
+        for prettify in passes:
+            tree = prettify(tree)
+        return tree
+    return pipeline
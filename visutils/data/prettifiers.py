@@ -163,6 +163,100 @@ def parse_native_types(tree, types=list(), functions=dict()):
                 tree[i] = _parse_native_type(tree[i], types=types)
     return tree
 
+# Patterns that tell, without trying them, which of the default types
+# _parse_native_type would convert a string to.  Each one only matches
+# strings that all the types before it are sure to reject; anything else
+# goes through _parse_native_type as before.
+_DIGITS_RE = re.compile(r'[+-]?[0-9]+\Z')
+_DECIMAL_RE = re.compile(r'[+-]?(?:[0-9]+\.[0-9]*|\.[0-9]+)\Z')
+_DATETIME_RE = re.compile(r'([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4})(?: ([0-9]{1,2}):([0-9]{2}))?\Z')
+# letters that can't appear in anything long, int, Decimal or the date
+# formats accept (those only allow the letters in 'infinity', 'nan' and 'el')
+_TEXT_RE = re.compile(r'[b-dg-hj-kmo-ru-xzB-DG-HJ-KMO-RU-XZ]')
+_KINDS = (
+    ('text', _TEXT_RE.search),
+    ('digits', _DIGITS_RE.match),
+    ('decimal', _DECIMAL_RE.match),
+    ('datetime', _DATETIME_RE.match),
+)
+_KIND_MATCHERS = dict(_KINDS)
+_SCHEMA_KINDS = {long: 'digits', int: 'digits', decimal.Decimal: 'decimal',
+                 datetime.datetime: 'datetime', str: 'text', unicode: 'text', basestring: 'text'}
+
+class NativeTypePlan(object):
+    '''
+    A prettifier that gives the same result as parse_native_types, but
+    remembers for each key what its values were converted to.  Later values
+    of the key are checked against that with a single pattern match and
+    converted with one direct call, instead of trying each type in turn
+    and failing with exceptions.  Values that don't fit the plan, and
+    types other than the defaults, fall back to _parse_native_type.
+    The plan is kept on the instance, so keep one around for responses
+    of the same shape.  It can be seeded with a schema of {key: type},
+    e.g. {'Amount': decimal.Decimal, 'Name': unicode}.
+    SKIP_KEYS and functions are handled as in parse_native_types.
+    '''
+    def __init__(self, types=list(), functions=dict(), schema=dict()):
+        if not len(types):
+            types = [long, int, decimal.Decimal, datetime.datetime]
+        self.types = types
+        self.functions = functions
+        self.kinds = dict((key, _SCHEMA_KINDS[t]) for key, t in schema.items())
+        names = [t.__name__ for t in types]
+        self._planned = all(t in (long, int, decimal.Decimal) or t.__name__ == 'datetime' for t in types)
+        self._number = ([t for t in types if t in (long, int, decimal.Decimal)] or [None])[0]
+        self._decimal = decimal.Decimal in types
+        self._datetime = 'datetime' in names
+
+    def parse(self, value, key=None):
+        if key is not None and key in self.functions:
+            return _parse_native_type(value, function=self.functions[key])
+        if not self._planned:
+            return _parse_native_type(value, types=self.types)
+        if value is None:
+            return value
+        if not isinstance(value, basestring):
+            return _parse_native_type(value, types=self.types)
+        kind = self.kinds.get(key)
+        match = kind and _KIND_MATCHERS[kind](value)
+        if not match:
+            for kind, matcher in _KINDS:
+                match = matcher(value)
+                if match:
+                    self.kinds[key] = kind
+                    break
+            else:
+                return _parse_native_type(value, types=self.types)
+        if kind == 'digits' and self._number:
+            return self._number(value)
+        elif kind == 'decimal' and self._decimal:
+            return decimal.Decimal(value)
+        elif kind == 'datetime' and self._datetime:
+            day, month, year, hour, minute = match.groups()
+            try:
+                if hour is None:
+                    return datetime.datetime(int(year), int(month), int(day))
+                return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute))
+            except ValueError:
+                return value
+        return value
+
+    def __call__(self, tree):
+        if isinstance(tree, dict):
+            for key in tree.keys():
+                if key in SKIP_KEYS: continue
+                if type(tree[key]) in _SEQ_TYPES:
+                    self(tree[key])
+                else:
+                    tree[key] = self.parse(tree[key], key)
+        elif isinstance(tree, list):
+            for i in range(len(tree)):
+                if type(tree[i]) in _SEQ_TYPES:
+                    self(tree[i])
+                else:
+                    tree[i] = self.parse(tree[i])
+        return tree
+
 
 def embed_hash_tags(tree):
     '''
@@ -265,13 +359,230 @@ class BaseObject(object):
         fields_string = ", ".join(sorted(self.__dict__.keys()))
         return u"<BaseObject: {fields}>".format(fields=fields_string)
 
-def objectify_tree(tree, collations=dict(), parent=''):
+class _ShapedObject(BaseObject):
+    '''
+    Base for the classes objectify_tree(slots=True) generates for each
+    distinct set of keys.  The keys are kept in __slots__; attributes set
+    later on, e.g. by the totals functions, still go into __dict__.
+    '''
+    __slots__ = ()
+    __getattribute__ = object.__getattribute__
+
+    def _field_names(self):
+        return list(self.__slots__) + self.__dict__.keys()
+
+    def __getattr__(self, item):
+        raise DataAttributeMissing(
+                "Attribute {key} does not exist. Possible choices are: {keys}".format(key=item,
+                                                                                      keys=', '.join(self._field_names()))
+        )
+
+    def __repr__(self):
+        fields_string = ", ".join(sorted(self._field_names()))
+        return u"<BaseObject: {fields}>".format(fields=fields_string)
+
+    def __reduce__(self):
+        # the generated classes can't be imported, so rebuild from the keys
+        return _make_shaped_object, (self.__slots__, tuple(getattr(self, name) for name in self.__slots__),
+                                     self.__dict__ or None)
+
+_IDENTIFIER = re.compile('[a-zA-Z_][0-9a-zA-Z_]*$')
+_SHAPES = {}
+_MAX_SHAPES = 4096
+_mangled_keys = {}
+
+def _shape(names):
+    '''
+    Returns the class for objects with the attributes in names and a setter
+    for each of them, or None if they can't be slots or _MAX_SHAPES classes
+    have been made already.
+    '''
+    shape = _SHAPES.get(names)
+    if shape is None:
+        if len(_SHAPES) >= _MAX_SHAPES:
+            return None
+        if not all(_IDENTIFIER.match(name) and not name.startswith('__') for name in names):
+            return None
+        cls = type('BaseObject', (_ShapedObject,), {'__slots__': names})
+        shape = _SHAPES[names] = cls, tuple(cls.__dict__[name].__set__ for name in names)
+    return shape
+
+def _make_shaped_object(names, values, extra=None):
+    shape = _shape(names)
+    if shape is None:
+        ret = BaseObject()
+        for name, value in zip(names, values):
+            object.__setattr__(ret, name, value)
+    else:
+        cls, setters = shape
+        ret = cls.__new__(cls)
+        for i in range(len(setters)):
+            setters[i](ret, values[i])
+    if extra:
+        for name, value in extra.items():
+            object.__setattr__(ret, name, value)
+    return ret
+
+def _objectify_shaped(tree, collations, parent):
+    attrs = {}
+    if isinstance(tree, dict):
+        for key in tree.keys():
+            value = tree[key]
+            colKey = None
+            if collations:
+                if parent+'.'+key in collations:
+                    colKey = parent+'.'+key
+                elif key in collations:
+                    colKey = key
+            if colKey is not None:
+                name = collations[colKey]
+                if not _IDENTIFIER.match(name):
+                    # let the plain version deal with (and fail on) these
+                    return objectify_tree(tree, collations=collations, parent=parent)
+                if not name in attrs:
+                    attrs[name] = list()
+                if isinstance(value, dict):
+                    attrs[name].append(_objectify_shaped(value, collations, key))
+                elif isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, list) or isinstance(item, dict):
+                            attrs[name].append(_objectify_shaped(item, collations, key))
+                        else:
+                            attrs[name].append(item)
+                else:
+                    attrs[name] = [value]
+            else:
+                try:
+                    name = _mangled_keys[key]
+                except KeyError:
+                    name = _non_id_char.sub('', key)
+                    if len(_mangled_keys) < _MAX_SHAPES:
+                        _mangled_keys[key] = name
+                if isinstance(value, dict):
+                    attrs[name] = _objectify_shaped(value, collations, key)
+                elif isinstance(value, list):
+                    attrs[name] = [_objectify_shaped(item, collations, key)
+                                   if isinstance(item, list) or isinstance(item, dict) else item
+                                   for item in value]
+                else:
+                    attrs[name] = value
+    names = tuple(sorted(attrs.keys()))
+    return _make_shaped_object(names, [attrs[name] for name in names])
+
+_MISSING = object()
+
+class LazyObject(BaseObject):
+    '''
+    A BaseObject view of a dict, as objectify_tree would make it, that only
+    converts the values that are read.  Child dicts become LazyObjects and
+    collations lists are built on first access, and are then kept on the
+    object.  The dict should not be changed while the view is in use.
+    '''
+    __slots__ = ('_tree', '_collations', '_parent', '_sources')
+    __getattribute__ = object.__getattribute__
+
+    def __init__(self, tree, collations=dict(), parent=''):
+        object.__setattr__(self, '_tree', tree)
+        object.__setattr__(self, '_collations', collations)
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, '_sources', None)
+
+    def _get_sources(self):
+        '''
+        Maps each attribute name to the keys it is made from, in the order
+        objectify_tree would have set them, with the collation name for
+        keys that are collated.
+        '''
+        sources = self._sources
+        if sources is None:
+            sources = {}
+            tree, collations = self._tree, self._collations
+            if isinstance(tree, dict):
+                for key in tree.keys():
+                    colKey = None
+                    if collations:
+                        if self._parent+'.'+key in collations:
+                            colKey = self._parent+'.'+key
+                        elif key in collations:
+                            colKey = key
+                    if colKey is not None:
+                        sources.setdefault(collations[colKey], []).append((key, True))
+                    else:
+                        sources.setdefault(_non_id_char.sub('', key), []).append((key, False))
+            object.__setattr__(self, '_sources', sources)
+        return sources
+
+    def _lazy(self, value, key):
+        if isinstance(value, list) or isinstance(value, dict):
+            return LazyObject(value, collations=self._collations, parent=key)
+        return value
+
+    def _field_names(self):
+        return list(set(self._get_sources().keys()) | set(self.__dict__.keys()))
+
+    def __getattr__(self, item):
+        if item in LazyObject.__slots__:
+            # not set up by __init__
+            raise AttributeError(item)
+        keys = self._get_sources().get(item)
+        if keys is None:
+            raise DataAttributeMissing(
+                    "Attribute {key} does not exist. Possible choices are: {keys}".format(key=item,
+                                                                                          keys=', '.join(self._field_names()))
+            )
+        value = _MISSING
+        for key, collated in keys:
+            source = self._tree[key]
+            if collated:
+                if value is _MISSING:
+                    value = list()
+                if isinstance(source, dict):
+                    value.append(self._lazy(source, key))
+                elif isinstance(source, list):
+                    value.extend(self._lazy(i, key) for i in source)
+                else:
+                    value = [source]
+            elif isinstance(source, dict):
+                value = self._lazy(source, key)
+            elif isinstance(source, list):
+                value = [self._lazy(i, key) for i in source]
+            else:
+                value = source
+        object.__setattr__(self, item, value)
+        return value
+
+    def __str__(self):
+        for name in ('text', 'Text'):
+            value = getattr(self, name, None)
+            if type(value) in (str, unicode):
+                return value
+        return 'BaseObject'
+
+    __unicode__ = __str__
+
+    def __repr__(self):
+        fields_string = ", ".join(sorted(self._field_names()))
+        return u"<BaseObject: {fields}>".format(fields=fields_string)
+
+    def __reduce__(self):
+        return LazyObject, (self._tree, self._collations, self._parent), self.__dict__ or None
+
+def objectify_tree(tree, collations=dict(), parent='', slots=False, lazy=False):
     '''
     Takes a dict and makes an object from it. Note that if this is called
     as a prettifier, it will not return a dict.
     If parent is set keys in the collations dict can be of the form 'parent.child'
     and the collations matcher will include the term in searches.
+    Pass slots=True to build the objects from classes that are generated,
+    and cached, for each distinct set of keys and keep their attributes in
+    __slots__.  They behave like BaseObject, which they subclass, but use
+    less memory and are faster to build as keys are only mangled once.
+    Pass lazy=True to get a LazyObject, which only converts what is read.
     '''
+    if lazy:
+        return LazyObject(tree, collations=collations, parent=parent)
+    if slots:
+        return _objectify_shaped(tree, collations, parent)
     ret = BaseObject()
     if isinstance(tree, dict):
         for key in tree.keys():
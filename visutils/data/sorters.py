@@ -1,51 +1,102 @@
 # encoding=utf-8
-import locale
-from django.conf import settings
+import heapq
+from visutils.isl.collation import collation_key, collate
+
+def _field_getter(field_notation):
+    '''
+    Returns a function that looks up a field like 'foo.bar' on an object.
+    Names that are missing are skipped, as in get_sub_notation.
+    '''
+    names = field_notation.split('.')
+    if len(names) == 1:
+        name = names[0]
+        def get(obj):
+            if hasattr(obj, name):
+                return getattr(obj, name)
+            return obj
+        return get
+    def get(obj):
+        ret = obj
+        for f in names:
+            if hasattr(ret, f):
+                ret = getattr(ret, f)
+        return ret
+    return get
+
+def _field_key(fields):
+    getters = [_field_getter(f) for f in fields]
+    if len(getters) == 1:
+        get = getters[0]
+        return lambda i: sort_key(get(i))
+    return lambda i: tuple([sort_key(get(i)) for get in getters])
+
+def _sorted(iterable, key, reverse, limit=None, offset=0):
+    '''
+    sorted(iterable, key=key, reverse=reverse)[offset:offset+limit], but
+    when a limit is given only the first offset+limit items are selected,
+    with a heap, instead of sorting the whole list.  heapq breaks ties by
+    position, so the result is the same as with a stable sort.
+    '''
+    if limit is None:
+        l = sorted(iterable, key=key, reverse=reverse)
+        return l[offset:] if offset else l
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    return select(offset + limit, iterable, key=key)[offset:]
+
+def _sorted_by_fields(l, fields, reverse, limit=None, offset=0):
+    '''
+    Sorts l by fields with a single key extraction per item and field.
+    reverse can be a list of flags, one per field.  Each run of fields
+    sorted in the same direction is done in one sort, so the result is the
+    same as sorting by each field in turn, last field first.  Only the run
+    of the first fields has to be ordered past limit and offset.
+    '''
+    if not fields:
+        if limit is None and not offset:
+            return l
+        return list(l)[offset:None if limit is None else offset + limit]
+    if isinstance(reverse, (list, tuple)):
+        if len(reverse) != len(fields):
+            raise ValueError('Expected one reverse flag per field')
+        flags = reverse
+    else:
+        flags = [reverse] * len(fields)
+    runs = []
+    for f, flag in zip(fields, flags):
+        if runs and runs[-1][1] == bool(flag):
+            runs[-1][0].append(f)
+        else:
+            runs.append(([f], bool(flag)))
+    for run_fields, flag in reversed(runs[1:]):
+        l = sorted(l, key=_field_key(run_fields), reverse=flag)
+    run_fields, flag = runs[0]
+    return _sorted(l, _field_key(run_fields), flag, limit, offset)
 
 def sort_list(l, *fields, **kwargs):
     '''
     Creates and sorts a list from the given l by the fields given in
     *fields IN REVERSE ORDER
     Pass reverse=True to reverse the sort itself ;)
+    or a list of flags, one per field, to reverse only some of the fields.
     You can pass in field names like 'foo.bar' and the method will
     search for and sort by the sub-value
+    Pass limit and offset to only get that slice of the sorted list, e.g.
+    one page of it, which is faster than sorting the whole list.
     '''
-    reverse = False
-    if 'reverse' in kwargs.keys():
-        reverse = kwargs['reverse']
-    def get_sub_notation(obj, field_notation):
-        ret = obj
-        for f in field_notation.split('.'):
-            if hasattr(ret, f):
-                ret = getattr(ret, f)
-        return ret
-    for f in reversed([f for f in fields]):
-        l = locale_sorted(l, key=lambda i: get_sub_notation(i, f), reverse=reverse)
-    return l
+    return _sorted_by_fields(l, fields, kwargs.get('reverse', False),
+                             kwargs.get('limit'), kwargs.get('offset', 0))
 
 def subnotation_sort_list(l, *fields, **kwargs):
-    reverse = False
-    if 'reverse' in kwargs.keys():
-        reverse = kwargs['reverse']
-    def get_sub_notation(obj, field_notation):
-        ret = obj
-        for f in field_notation.split('.'):
-            if hasattr(ret, f):
-                ret = getattr(ret, f)
-        return ret
-    for f in reversed([f for f in fields]):
-        l = locale_sorted(l, key=lambda i: get_sub_notation(i, f), reverse=reverse)
-    return l
-
+    return _sorted_by_fields(l, fields, kwargs.get('reverse', False),
+                             kwargs.get('limit'), kwargs.get('offset', 0))
 
-locale.setlocale(locale.LC_ALL, settings.SORTING_LOCALE)
 
 class SortingTypeMismatchError(Exception):
     pass
 
 def safe_collate(object1, object2):
     """
-    A comparison function that uses locale string collation to sort strings,
+    A comparison function that uses Icelandic collation to sort strings,
     and assumes that None values are strings, but otherwise uses `cmp`.
     """
     if object1 is None:
@@ -53,9 +104,23 @@ def safe_collate(object1, object2):
     if object2 is None:
         object2 = ''
     if isinstance(object1, basestring) and isinstance(object2, basestring):
-        return locale.strcoll(object1, object2)
+        return collate(object1, object2)
     else:
         return cmp(object1, object2)
 
-def locale_sorted(iterable, key=None, reverse=False):
-    return sorted(iterable, cmp=safe_collate, key=key, reverse=reverse)
\ No newline at end of file
+def sort_key(value):
+    """
+    A sort key that orders values the same way as safe_collate, so that
+    sorts can compute it once per item instead of comparing with `cmp`.
+    Strings sort after other values, as they do with `cmp` for numbers.
+    """
+    if value is None:
+        value = ''
+    if isinstance(value, basestring):
+        return 1, collation_key(value)
+    return 0, value
+
+def locale_sorted(iterable, key=None, reverse=False, limit=None, offset=0):
+    if key is None:
+        return _sorted(iterable, sort_key, reverse, limit, offset)
+    return _sorted(iterable, lambda i: sort_key(key(i)), reverse, limit, offset)
@@ -1,6 +1,57 @@
 # encoding=utf-8
+from array import array
 from copy import deepcopy
-from visutils.data.sorters import locale_sorted
+from itertools import izip
+from visutils.data.sorters import locale_sorted, sort_list, _field_getter
+from visutils.data.prettifiers import BaseObject
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_INT64_MAX = 2 ** 63 - 1
+
+def _running_totals(values):
+    '''
+    Returns the running totals of values, starting from 0 as totalize_list
+    does.  Columns of plain ints or floats are summed with numpy.cumsum,
+    which adds in the same order, anything else (Decimal, mixed types) is
+    added up in Python.
+    '''
+    if numpy is not None and values:
+        types = set(type(v) for v in values)
+        if types <= set([int, bool]):
+            if max(abs(v) for v in values) * len(values) <= _INT64_MAX:
+                return numpy.cumsum(values, dtype=numpy.int64).tolist()
+        elif types == set([float]):
+            return numpy.cumsum(values, dtype=numpy.float64).tolist()
+    totals, total = [], 0
+    for value in values:
+        total = total + value
+        totals.append(total)
+    return totals
+
+def total_columns(l, *fields):
+    '''
+    Returns a dict with a list of running totals for each of the fields in
+    *fields, one total for each item in l, without changing the items.
+    Fields can be named 'foo.bar' as in totalize_list.
+    '''
+    columns = {}
+    for key in fields:
+        get = _field_getter(key)
+        columns[key] = _running_totals([get(i) for i in l])
+    return columns
+
+def write_totals(l, columns):
+    '''
+    Sets the totals from total_columns on the items of l as totalize_list
+    does, e.g. the total of 'foo.bar' as foo_bar_total.
+    '''
+    for key, column in columns.items():
+        name = key.replace('.', '_')+'_total'
+        for i, total in izip(l, column):
+            setattr(i, name, total)
 
 def totalize_list(l, *fields, **named):
     '''
@@ -11,32 +62,196 @@ def totalize_list(l, *fields, **named):
     and create a new deep copy of the first list instance with the
     relevant attributes set to their respective totals
     NOTE: inline declaration does not support sub-notation!
+    Use total_columns to get the totals without changing the list.
     '''
-    def get_sub_notation(obj, field_notation):
-        ret = obj
-        for f in field_notation.split('.'):
-            if hasattr(ret, f):
-                ret = getattr(ret, f)
-        return ret
-    inline = True
-    if 'inline' in named.keys():
-        inline=named['inline']
-    fields = [n for n in fields]
-    totals = {}
-    for key in fields:
-        totals[key] = 0
-    for i in l:
-        for key in fields:
-            totals[key] = totals[key]+get_sub_notation(i, key)
-            if inline:
-                setattr(i, key.replace('.', '_')+'_total', totals[key])
+    inline = named.get('inline', True)
+    columns = total_columns(l, *fields)
+    if inline:
+        write_totals(l, columns)
     if len(l) > 0 and not inline:
         new_val = deepcopy(l[0])
         for key in fields:
-            setattr(new_val, key, totals[key])
+            setattr(new_val, key, columns[key][-1])
         l.append(new_val)
     return l
 
+def _set_group_flags(group, list_index, at_end, list_count=None):
+    count = len(group)
+    for n, i in enumerate(group):
+        index = list_index + n
+        last = at_end and n == count-1
+        if last:
+            # last item in list
+            setattr(i, '_last', True)
+        setattr(i, 'list_index', index)
+        if list_count is not None:
+            setattr(i, 'list_count', list_count)
+        setattr(i, 'list_first', index == 0)
+        setattr(i, 'list_last', last)
+        setattr(i, 'list_pleb', index != 0 and not last)
+        setattr(i, 'group_count', count)
+        setattr(i, 'group_first', n == 0)
+        setattr(i, 'group_index', n)
+        setattr(i, 'group_pleb', n != 0 and n != count-1)
+        setattr(i, 'group_last', n == count-1)
+
+def _iter_sub_totals(iterable, group_field, fields, list_count=None):
+    get_group = _field_getter(group_field)
+    columns = [(_field_getter(f), f.replace('.', '_')+'_total', f.replace('.', '_')+'_group_total')
+               for f in fields]
+    current_totals = [0] * len(columns)
+    group, group_val, list_index = [], None, 0
+    for i in iterable:
+        val = get_group(i)
+        if not group or val != group_val:
+            if group:
+                _set_group_flags(group, list_index, False, list_count)
+                for item in group:
+                    yield item
+                list_index += len(group)
+                group = []
+            group_val = val
+            group_totals = [0] * len(columns)
+        for n, (get, total_name, group_total_name) in enumerate(columns):
+            value = get(i)
+            current_totals[n] = current_totals[n] + value
+            setattr(i, total_name, current_totals[n])
+            group_totals[n] = group_totals[n] + value
+            setattr(i, group_total_name, group_totals[n])
+        group.append(i)
+    if group:
+        _set_group_flags(group, list_index, True, list_count)
+        for item in group:
+            yield item
+
+def iter_sub_totals(iterable, group_field, *fields):
+    '''
+    Yields the items of an iterable that is already sorted by group_field,
+    with the same totals and group_* and list_* attributes as
+    sub_totalize_list sets, except list_count as the length isn't known.
+    Each group is held back until the next one starts, so that group_count
+    and group_last can be set, and only one group is in memory at a time.
+    '''
+    return _iter_sub_totals(iterable, group_field, fields)
+
+class _SubTotalsRow(object):
+    '''
+    A row of SubTotals.  The totals and the group_* and list_* flags are
+    looked up in the SubTotals, everything else on the source object.
+    '''
+    __slots__ = ('_result', '_index')
+
+    def __init__(self, result, index):
+        object.__setattr__(self, '_result', result)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, item):
+        if item in _SubTotalsRow.__slots__:
+            raise AttributeError(item)
+        value = self._result._annotation(self._index, item)
+        if value is _NO_ANNOTATION:
+            return getattr(self._result.rows[self._index], item)
+        return value
+
+    def __setattr__(self, item, value):
+        setattr(self._result.rows[self._index], item, value)
+
+    def __str__(self):
+        return str(self._result.rows[self._index])
+
+    def __unicode__(self):
+        return unicode(self._result.rows[self._index])
+
+    def __repr__(self):
+        return repr(self._result.rows[self._index])
+
+_NO_ANNOTATION = object()
+
+class SubTotals(object):
+    '''
+    The result of sub_totalize_list(views=True): the sorted rows, where the
+    group of each row, the group boundaries and the total columns are kept
+    in arrays instead of being set on the rows.  Indexing and iterating
+    give row views with the same attribute names sub_totalize_list sets,
+    which are computed when they are read, so the source objects are left
+    as they are.
+    '''
+    def __init__(self, rows, group_field, fields):
+        self.rows = rows
+        get_group = _field_getter(group_field)
+        self.row_groups = array('l')
+        self.group_starts = array('l')
+        group_val = None
+        for i, item in enumerate(rows):
+            val = get_group(item)
+            if i == 0 or val != group_val:
+                self.group_starts.append(i)
+                group_val = val
+            self.row_groups.append(len(self.group_starts)-1)
+        self.group_starts.append(len(rows))
+
+        self.columns = {}
+        for f in fields:
+            get = _field_getter(f)
+            values = [get(i) for i in rows]
+            group_totals, total, row_groups = [], 0, self.row_groups
+            for i, value in enumerate(values):
+                if i == 0 or row_groups[i] != row_groups[i-1]:
+                    total = 0
+                total = total + value
+                group_totals.append(total)
+            self.columns[f.replace('.', '_')+'_total'] = _running_totals(values)
+            self.columns[f.replace('.', '_')+'_group_total'] = group_totals
+
+    def _annotation(self, i, item):
+        column = self.columns.get(item)
+        if column is not None:
+            return column[i]
+        count = len(self.rows)
+        if item.startswith('list_'):
+            if item == 'list_index':
+                return i
+            elif item == 'list_count':
+                return count
+            elif item == 'list_first':
+                return i == 0
+            elif item == 'list_last':
+                return i == count-1
+            elif item == 'list_pleb':
+                return i != count-1 and i != 0
+        elif item.startswith('group_'):
+            group = self.row_groups[i]
+            start, end = self.group_starts[group], self.group_starts[group+1]
+            if item == 'group_index':
+                return i - start
+            elif item == 'group_count':
+                return end - start
+            elif item == 'group_first':
+                return i == start
+            elif item == 'group_last':
+                return i == end-1
+            elif item == 'group_pleb':
+                return i != start and i != end-1
+        elif item == '_last' and i == count-1:
+            return True
+        return _NO_ANNOTATION
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_SubTotalsRow(self, i) for i in range(*index.indices(len(self.rows)))]
+        if index < 0:
+            index += len(self.rows)
+        if not 0 <= index < len(self.rows):
+            raise IndexError(index)
+        return _SubTotalsRow(self, index)
+
+    def __iter__(self):
+        for i in range(len(self.rows)):
+            yield _SubTotalsRow(self, i)
+
 def sub_totalize_list(l, group_field, *fields, **kwargs):
     '''
     Create and return a list of BaseObject instance where attribuets
@@ -44,72 +259,167 @@ def sub_totalize_list(l, group_field, *fields, **kwargs):
     attributes defined in *fields as grouped-by group_field
     You can pass in fields named 'foo.bar' and there will be totals
     that have the name 'foo_bar_total' on the objects in the list
+    Use iter_sub_totals for data that is already sorted.
+    Pass views=True to get a SubTotals instead, which gives the same
+    attributes without setting them on the objects.
     '''
-    # TODO: this could use a little cleaning
-    # do this with kwargs to get argument order right
     reverse = kwargs.get('reverse', False)
+    get_group = _field_getter(group_field)
+    l = locale_sorted(l, key=get_group, reverse=reverse)
+    if kwargs.get('views', False):
+        return SubTotals(l, group_field, fields)
+    return list(_iter_sub_totals(l, group_field, fields, list_count=len(l)))
 
-    def get_sub_notation(obj, field_notation):
-        ret = obj
-        for f in field_notation.split('.'):
-            if hasattr(ret, f):
-                ret = getattr(ret, f)
-        return ret
-    fields = [f for f in fields]
-    current_totals, group_totals, field_total_names, group_total_names, group_counts = dict(), dict(), dict(), dict(), dict()
-    group_index_name = 'group_index' #'_'+group_field.replace('.', '_')+'_index'
-    group_count_name = 'group_count' #'_'+group_field.replace('.', '_')+'_count'
-    group_last_name = 'group_last' #'_'+group_field.replace('.', '_')+'_last'
-    group_first_name = 'group_first' #'_'+group_field.replace('.', '_')+'_first'
-    group_pleb_name = 'group_pleb' #'_'+group_field.replace('.', '_')+'_pleb'
-    group_index, group_count, total_count, total_index = 0, 0, 0 ,0
-    for f in fields:
-        current_totals[f] = 0
-        field_total_names[f] = f.replace('.', '_')+'_total'
-        group_totals[f] = 0
-        group_total_names[f] = f.replace('.', '_')+'_group_total'
-    group_val = None
-    l = locale_sorted(l, key=lambda i: get_sub_notation(i, group_field), reverse=reverse)
-    for i in l:
-        if get_sub_notation(i, group_field) != group_val:
-            for f in fields:
-                group_totals[f] = 0
-            group_val = get_sub_notation(i, group_field)
-            group_counts[group_val] = 0
-        for f in fields:
-            current_totals[f] = current_totals[f] + get_sub_notation(i, f)
-            setattr(i, field_total_names[f], current_totals[f])
-            group_totals[f] = group_totals[f] + get_sub_notation(i, f)
-            setattr(i, group_total_names[f], group_totals[f])
-        group_counts[group_val] += 1
-
-    group_val = None
-    for i in range(len(l)):
-        if get_sub_notation(l[i], group_field) != group_val:
-            setattr(l[i], group_first_name, True)
-            if i != 0:
-                # set for last item in previous group
-                setattr(l[i-1], group_last_name, True)
-            group_val = get_sub_notation(l[i], group_field)
-            group_count = group_counts[group_val]
-            group_index = 0
-        if i == len(l)-1:
-            # last item in list
-            setattr(l[i], group_last_name, True)
-            setattr(l[i], group_pleb_name, False)
-            setattr(l[i], '_last', True)
-        setattr(l[i], 'list_index', i)
-        setattr(l[i], 'list_count', len(l))
-        setattr(l[i], 'list_first', i == 0)
-        setattr(l[i], 'list_last', i == len(l)-1)
-        setattr(l[i], 'list_pleb', i != len(l)-1 and i != 0)
-        setattr(l[i], group_count_name, group_counts[group_val])
-        setattr(l[i], group_first_name, group_index == 0)
-        setattr(l[i], group_index_name, group_index)
-        setattr(l[i], group_pleb_name, group_index != 0 and group_index != group_count-1)
-        setattr(l[i], group_last_name, group_index == group_count-1)
-        group_index += 1
-        total_index += 1
-        total_count += 1
+def rollup_list(l, group_fields, *fields, **kwargs):
+    '''
+    Create and return a list sorted by all of group_fields, with running
+    totals of *fields and subtotals for every level of grouping, e.g.
+    group_fields=['region', 'office', 'agent'], in one sort and one pass.
 
-    return l
+    Each level has its own names, by default the group field with dots
+    replaced by '_', or as given in names=[...].  For a level named office
+    and a field named amount the rows get amount_office_total, the running
+    total within the office, and office_index, office_count, office_first
+    and office_last.  amount_total is the running total of the whole list.
+
+    Pass total_rows=True to also get a BaseObject after each group, and a
+    grand total at the end, with the totals set as the fields, the group
+    values by level name, rollup_level set to the level name (None for the
+    grand total) and rollup_count to the number of rows.
+    '''
+    reverse = kwargs.get('reverse', False)
+    names = kwargs.get('names') or [g.replace('.', '_') for g in group_fields]
+    total_rows = kwargs.get('total_rows', False)
+    if len(names) != len(group_fields):
+        raise ValueError('Expected one name per group field')
+    l = sort_list(l, *group_fields, reverse=reverse)
+
+    group_getters = [_field_getter(g) for g in group_fields]
+    getters = [_field_getter(f) for f in fields]
+    total_names = [f.replace('.', '_')+'_total' for f in fields]
+    level_total_names = [[f.replace('.', '_')+'_'+name+'_total' for f in fields] for name in names]
+    levels, columns = range(len(group_fields)), range(len(fields))
+    totals = [0] * len(fields)
+    level_totals = [[0] * len(fields) for level in levels]
+    starts = [0] * len(group_fields)
+    group_vals = None
+    ret = []
+
+    def total_row(level, level_vals, level_total, count):
+        row = BaseObject()
+        for m in range(level + 1):
+            setattr(row, names[m], level_vals[m])
+        for n in columns:
+            setattr(row, fields[n], level_total[n])
+        row.rollup_level = names[level] if level >= 0 else None
+        row.rollup_count = count
+        return row
+
+    def close(level, end):
+        # flag the groups from the innermost level out to level
+        for k in reversed(levels[level:]):
+            name, start = names[k], starts[k]
+            for j in range(start, end):
+                setattr(l[j], name+'_count', end - start)
+                setattr(l[j], name+'_last', j == end-1)
+            if total_rows:
+                ret.append(total_row(k, group_vals, level_totals[k], end - start))
+
+    for i, item in enumerate(l):
+        vals = [get(item) for get in group_getters]
+        changed = None
+        if group_vals is None:
+            changed = 0
+        else:
+            for k in levels:
+                if vals[k] != group_vals[k]:
+                    changed = k
+                    break
+        if changed is not None:
+            if group_vals is not None:
+                close(changed, i)
+            for k in levels[changed:]:
+                starts[k] = i
+                level_totals[k] = [0] * len(fields)
+            group_vals = vals
+        values = [get(item) for get in getters]
+        for n in columns:
+            totals[n] = totals[n] + values[n]
+            setattr(item, total_names[n], totals[n])
+        for k in levels:
+            level_total = level_totals[k]
+            for n in columns:
+                level_total[n] = level_total[n] + values[n]
+                setattr(item, level_total_names[k][n], level_total[n])
+            setattr(item, names[k]+'_index', i - starts[k])
+            setattr(item, names[k]+'_first', i == starts[k])
+        ret.append(item)
+    if group_vals is not None:
+        close(0, len(l))
+    if total_rows:
+        ret.append(total_row(-1, [], totals, len(l)))
+    return ret
+
+class TotalsAccumulator(object):
+    '''
+    Keeps running totals of *fields, and per group totals when group_field
+    is given, over rows that arrive in batches, e.g. page by page, so that
+    each batch only costs its own size.  extend sets the same <field>_total
+    and <field>_group_total attributes as sub_totalize_list on the rows
+    unless inline=False is passed.  Groups are counted by value, so the rows
+    don't need to be sorted.
+    '''
+    def __init__(self, *fields, **kwargs):
+        self.fields = list(fields)
+        self.group_field = kwargs.get('group_field')
+        self.inline = kwargs.get('inline', True)
+        self._getters = [_field_getter(f) for f in self.fields]
+        self._total_names = [f.replace('.', '_')+'_total' for f in self.fields]
+        self._group_total_names = [f.replace('.', '_')+'_group_total' for f in self.fields]
+        self._get_group = _field_getter(self.group_field) if self.group_field else None
+        self.count = 0
+        self.totals = [0] * len(self.fields)
+        self.group_counts = {}
+        self.group_totals = {}
+
+    def extend(self, rows):
+        '''
+        Adds rows to the totals and returns them.
+        '''
+        fields = range(len(self.fields))
+        totals, inline = self.totals, self.inline
+        for row in rows:
+            values = [get(row) for get in self._getters]
+            for n in fields:
+                totals[n] = totals[n] + values[n]
+                if inline:
+                    setattr(row, self._total_names[n], totals[n])
+            if self._get_group is not None:
+                group = self._get_group(row)
+                group_totals = self.group_totals.get(group)
+                if group_totals is None:
+                    group_totals = self.group_totals[group] = [0] * len(self.fields)
+                    self.group_counts[group] = 0
+                self.group_counts[group] += 1
+                for n in fields:
+                    group_totals[n] = group_totals[n] + values[n]
+                    if inline:
+                        setattr(row, self._group_total_names[n], group_totals[n])
+            self.count += 1
+        return rows
+
+    def snapshot(self):
+        '''
+        Returns the totals so far as a dict with 'count', 'totals' by field
+        and, when grouping, 'group_counts' and 'group_totals' by group value.
+        Later calls to extend don't change it.
+        '''
+        ret = {
+            'count': self.count,
+            'totals': dict(zip(self.fields, self.totals)),
+        }
+        if self._get_group is not None:
+            ret['group_counts'] = dict(self.group_counts)
+            ret['group_totals'] = dict((group, dict(zip(self.fields, totals)))
+                                       for group, totals in self.group_totals.items())
+        return ret
@@ -2,93 +2,162 @@
 import re
 from lxml import objectify, etree
 import xml.sax.handler
+import xml.sax.xmlreader
+from xml.parsers import expat
 from xml.dom import minidom as dom
 import json as simplejson
 _non_id_char = re.compile('[^_0-9a-zA-Z]')
 import collections
+from io import BytesIO
+from visutils.data.pipeline import compile_prettifiers
 
 
+class DataNode(object):
+    """
+    An element of the tree xml2obj returns.  XML attributes and child
+    elements are read as attributes, or with [], and an element that
+    occurs more than once gives a list.
+    """
+    __slots__ = ('_attrs', 'data')
+
+    def __init__(self):
+        self._attrs = {}    # XML attributes and child elements
+        self.data = None    # child text data
+    def __len__(self):
+        # treat single element as a list of 1
+        return 1
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self._attrs.get(key)
+        else:
+            return [self][key]
+    def __contains__(self, name):
+        return self._attrs.has_key(name)
+    def __nonzero__(self):
+        return bool(self._attrs or self.data)
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_attrs':
+            # need to do this for Python special methods???
+            raise AttributeError(name)
+        return self._attrs.get(name)
+    def _add_xml_attr(self, name, value):
+        if name in self._attrs:
+            # multiple attribute of the same name are represented by a list
+            children = self._attrs[name]
+            if not isinstance(children, list):
+                children = [children]
+                self._attrs[name] = children
+            children.append(value)
+        else:
+            self._attrs[name] = value
+    def __str__(self):
+        return self.data or ''
+    def __repr__(self):
+        items = sorted(self._attrs.items())
+        if self.data:
+            items.append(('data', self.data))
+        return u'{%s}' % ', '.join([u'%s:%s' % (k,repr(v)) for k,v in items])
+
+_obj_names = {}
+
+def _obj_name(name):
+    # the mangled names of xml2obj, which are looked up for every element
+    mangled = _obj_names.get(name)
+    if mangled is None:
+        mangled = _non_id_char.sub('_', unicode(name))
+        if len(_obj_names) < 4096:
+            _obj_names[name] = mangled
+    return mangled
+
+class _ExpatLocator(xml.sax.xmlreader.Locator):
+    # where expat stopped in a file that can't be read again for SAX
+    def __init__(self, src, parser):
+        self._system_id = getattr(src, 'name', None)
+        self._line = parser.ErrorLineNumber
+        self._column = parser.ErrorColumnNumber
+    def getSystemId(self):
+        return self._system_id
+    def getLineNumber(self):
+        return self._line
+    def getColumnNumber(self):
+        return self._column
+
 def xml2obj(src):
     """
     A simple function to converts XML data into native Python object.
+    The XML is parsed by expat, as xml.sax does it, but without the SAX
+    handler layers in between.
     """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    stack = []
+    push, pop = stack.append, stack.pop
+    new_node = DataNode.__new__
+    # the attributes and text parts of the element being parsed
+    top = [{}, []]
 
-    non_id_char = re.compile('[^_0-9a-zA-Z]')
-    def _name_mangle(name):
-        return non_id_char.sub('_', name)
-
-    class DataNode(object):
-        def __init__(self):
-            self._attrs = {}    # XML attributes and child elements
-            self.data = None    # child text data
-        def __len__(self):
-            # treat single element as a list of 1
-            return 1
-        def __getitem__(self, key):
-            if isinstance(key, basestring):
-                return self._attrs.get(key)
-            else:
-                return [self][key]
-        def __contains__(self, name):
-            return self._attrs.has_key(name)
-        def __nonzero__(self):
-            return bool(self._attrs or self.data)
-        def __getattr__(self, name):
-            if name.startswith('__'):
-                # need to do this for Python special methods???
-                raise AttributeError(name)
-            return self._attrs.get(name)
-        def _add_xml_attr(self, name, value):
-            if name in self._attrs:
-                # multiple attribute of the same name are represented by a list
-                children = self._attrs[name]
-                if not isinstance(children, list):
-                    children = [children]
-                    self._attrs[name] = children
-                children.append(value)
-            else:
-                self._attrs[name] = value
-        def __str__(self):
-            return self.data or ''
-        def __repr__(self):
-            items = sorted(self._attrs.items())
-            if self.data:
-                items.append(('data', self.data))
-            return u'{%s}' % ', '.join([u'%s:%s' % (k,repr(v)) for k,v in items])
-
-    class TreeBuilder(xml.sax.handler.ContentHandler):
-        def __init__(self):
-            self.stack = []
-            self.root = DataNode()
-            self.current = self.root
-            self.text_parts = []
-        def startElement(self, name, attrs):
-            self.stack.append((self.current, self.text_parts))
-            self.current = DataNode()
-            self.text_parts = []
-            # xml attributes --> python attributes
-            for k, v in attrs.items():
-                self.current._add_xml_attr(_name_mangle(k), v)
-        def endElement(self, name):
-            text = ''.join(self.text_parts).strip()
-            if text:
-                self.current.data = text
-            if self.current._attrs:
-                obj = self.current
-            else:
-                # a text only node is simply represented by the string
-                obj = text or ''
-            self.current, self.text_parts = self.stack.pop()
-            self.current._add_xml_attr(_name_mangle(name), obj)
-        def characters(self, content):
-            self.text_parts.append(content)
-
-    builder = TreeBuilder()
-    if isinstance(src,basestring):
-        xml.sax.parseString(src, builder)
+    def add(attrs, name, value):
+        name_ = _obj_names.get(name)
+        if name_ is None:
+            name_ = _obj_name(name)
+        if name_ in attrs:
+            # multiple attribute of the same name are represented by a list
+            children = attrs[name_]
+            if not isinstance(children, list):
+                children = attrs[name_] = [children]
+            children.append(value)
+        else:
+            attrs[name_] = value
+
+    def start(name, xml_attrs):
+        push((top[0], top[1]))
+        attrs = {}
+        # xml attributes --> python attributes
+        for k, v in xml_attrs.iteritems():
+            add(attrs, k, v)
+        top[0], top[1] = attrs, []
+
+    def end(name):
+        attrs, text_parts = top
+        text = u''.join(text_parts).strip()
+        if attrs:
+            obj = new_node(DataNode)
+            obj._attrs = attrs
+            obj.data = text or None
+        else:
+            # a text only node is simply represented by the string
+            obj = text or ''
+        top[0], top[1] = pop()
+        add(top[0], name, obj)
+
+    def characters(content):
+        top[1].append(content)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = characters
+    if isinstance(src, basestring):
+        try:
+            parser.Parse(src, True)
+        except expat.ExpatError:
+            # raise the error the SAX parser used to
+            xml.sax.parseString(src, xml.sax.handler.ContentHandler())
+            raise
     else:
-        xml.sax.parse(src, builder)
-    return builder.root._attrs.values()[0]
+        try:
+            start = src.tell()
+        except (AttributeError, IOError):
+            start = None
+        try:
+            parser.ParseFile(src)
+        except expat.ExpatError as e:
+            if start is None:
+                raise xml.sax.SAXParseException(expat.ErrorString(e.code), e, _ExpatLocator(src, parser))
+            # raise the error the SAX parser used to, from where the file was
+            src.seek(start)
+            xml.sax.parse(src, xml.sax.handler.ContentHandler())
+            raise
+    return top[0].values()[0]
 
 def xml2json(src, prettifiers=dict()):
     enc = simplejson.JSONEncoder()
@@ -127,9 +196,134 @@ def xml2struct(src, prettifiers=dict(), ignore=list()):
     xml = dom.parseString(src)
     for node in xml.childNodes:
         traverse(node, ret)
-    for prettifier in prettifiers:
-        ret = prettifier(ret)
-    return ret
+    return compile_prettifiers(prettifiers)(ret)
+
+_XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+def _qualified_name(tag, elem):
+    """
+    Returns the minidom style ``prefix:name`` for an lxml ``{uri}name`` tag
+    or attribute key found on elem.
+    """
+    if not tag.startswith('{'):
+        return tag
+    uri, name = tag[1:].split('}', 1)
+    if uri == _XML_NAMESPACE:
+        prefix = 'xml'
+    elif tag == elem.tag:
+        prefix = elem.prefix
+    else:
+        prefix = None
+        for p, u in elem.nsmap.items():
+            if u == uri and p:
+                prefix = p
+                break
+    if prefix:
+        return u'%s:%s' % (prefix, name)
+    return name
+
+def _struct_add_node(d, name, c):
+    if name in d.keys():
+        if isinstance(d[name], list):
+            d[name].append(c)
+        else:
+            old = d[name]
+            d[name] = [old, c]
+    else:
+        d[name] = c
+
+def _struct_add_text(d, data):
+    # mirrors how xml2struct's traverse handles minidom text nodes
+    d[u'#text'] = unicode(data)
+    if u'text' in d.keys():
+        _struct_add_node(d, u'text', dict())
+
+def _element_struct(elem, declarations, ignore):
+    c = dict()
+    for prefix, uri in declarations.get(elem, ()):
+        key = prefix and u'xmlns:' + prefix or u'xmlns'
+        if key not in ignore:
+            c[u'@'+key] = unicode(uri)
+    for key, value in elem.attrib.items():
+        key = _qualified_name(key, elem)
+        if key in ignore:
+            continue
+        c[u'@'+key] = unicode(value)
+    text_ignored = '#text' in ignore
+    if elem.text and not text_ignored:
+        _struct_add_text(c, elem.text)
+    for child in elem:
+        # comments and processing instructions have non-string tags
+        if isinstance(child.tag, basestring):
+            name = _qualified_name(child.tag, child)
+            if name not in ignore:
+                _struct_add_node(c, unicode(_non_id_char.sub('', name)),
+                                 _element_struct(child, declarations, ignore))
+        if child.tail and not text_ignored:
+            _struct_add_text(c, child.tail)
+    return c
+
+def iter_xml_records(src, record_path, prettifiers=list(), ignore=list()):
+    """
+    Incrementally parses the XML in src and yields one struct for each
+    element found at record_path, using the same ``@attr``/``#text`` layout
+    and ``ignore`` handling as xml2struct. Each record is freed from the
+    parse tree once it has been yielded, so memory use stays flat no matter
+    how large src is.
+
+    src can be a string or a file object.  record_path is a '/' separated
+    list of element names, in their xml2struct (mangled) form, that is
+    matched against the end of each element's path, e.g. 'Policy' or
+    'Policies/Policy'.  Records nested within a record are returned as part
+    of the outer record.  The prettifiers are applied to each record.
+
+    Unlike minidom, lxml merges CDATA sections into the surrounding text.
+
+    >>> src = '<r><p id="1">a</p><p id="2">b</p></r>'
+    >>> [sorted(p.items()) for p in iter_xml_records(src, 'r/p')]
+    [[(u'#text', u'a'), (u'@id', u'1')], [(u'#text', u'b'), (u'@id', u'2')]]
+    """
+    if isinstance(src, basestring):
+        if isinstance(src, unicode):
+            src = src.encode("utf-8", "ignore")
+        src = BytesIO(src)
+    record_path = [p for p in record_path.split('/') if p]
+    depth = len(record_path)
+    path, declarations, pending = [], {}, []
+    record, skipping = None, 0
+    prettify = compile_prettifiers(prettifiers)
+    for event, elem in etree.iterparse(src, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            pending.append(elem)
+        elif event == 'start':
+            name = _qualified_name(elem.tag, elem)
+            path.append(_non_id_char.sub('', name))
+            if skipping or name in ignore:
+                skipping += 1
+            elif record is None and path[-depth:] == record_path:
+                record = elem
+            if pending:
+                if record is not None:
+                    declarations[elem] = pending
+                pending = []
+        else:
+            path.pop()
+            if skipping:
+                skipping -= 1
+            if elem is record:
+                ret = _element_struct(elem, declarations, ignore)
+                record = None
+                declarations.clear()
+                # drop the record and everything before it from the tree
+                elem.clear()
+                parent = elem.getparent()
+                # the root has no parent, but comments before it are siblings
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
+                yield prettify(ret)
+            elif record is None:
+                elem.clear()
 
 def dict_to_etree_element(parent_name, dictionary):
     """
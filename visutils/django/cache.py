@@ -1,19 +1,36 @@
+import cPickle as pickle
 import inspect
 import logging
+import os
+import threading
 import time
 import types
+import uuid
 import warnings
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.cache import cache as django_cache
+from visutils.data.lru import LRUCache
+from visutils.django.metrics import MetricsRegistry, SIZE_BOUNDS
 
 class debug_cache(object):
     ignore = [ 'to_slug', 'repodownloadsize' ] # ignore keys starting with these
 
+    @staticmethod
+    def ignored(keys):
+        # the key of get and set, or the list or dict of get_many and set_many
+        if isinstance(keys, basestring):
+            keys = [keys]
+        keys = [key for key in keys if isinstance(key, basestring)]
+        return bool(keys) and all(key.startswith(tuple(debug_cache.ignore)) for key in keys)
+
     def __getattr__(self, attr):
         def wraps(f):
             def i(*args, **kwargs):
-                if not any([ args[0].startswith(ig) for ig in debug_cache.ignore ]):
+                if not (args and debug_cache.ignored(args[0])):
                     logging.info("CACHE %s: args=%s, kwargs=%s" % (attr, args, kwargs))
                 value = f(*args, **kwargs)
                 return value
@@ -25,8 +42,258 @@ if getattr(settings, 'DEBUG_CACHE', False):
 else:
     cache = django_cache
 
+class LocalCache(object):
+    '''
+    A per-process cache in front of the shared cache, bounded by number of
+    entries and approximate size in bytes (the size stored in the shared
+    cache, or the pickled size if that isn't known), with least
+    recently used entries dropped first.  Values are returned as they were
+    stored, not copies, so they must not be changed by the callers.
+    '''
+    def __init__(self, max_entries=1000, max_bytes=32*1024*1024, timeout=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, size, value = entry
+            if expires < time.time():
+                self.bytes -= size
+                return default
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None, size=None):
+        '''
+        Stores value for at most self.timeout seconds, or timeout if that is
+        shorter.  The value is pickled to measure it unless its size is
+        given, and values that can't be pickled aren't stored.
+        '''
+        if size is None:
+            try:
+                size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                return
+        if size > self.max_bytes:
+            return
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+            self._entries[key] = (time.time() + timeout, size, value)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                old_key, (expires, old_size, old_value) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+local_cache = LocalCache(
+    max_entries=getattr(settings, 'CACHEWRAP_LOCAL_MAX_ENTRIES', 1000),
+    max_bytes=getattr(settings, 'CACHEWRAP_LOCAL_MAX_BYTES', 32*1024*1024),
+    timeout=getattr(settings, 'CACHEWRAP_LOCAL_TIMEOUT', 60),
+)
+
+# counters and histograms of cachewrap functions, see MetricsRegistry
+metrics = MetricsRegistry(
+    histograms={'value_size': SIZE_BOUNDS},
+    sample_rate=getattr(settings, 'CACHEWRAP_METRICS_SAMPLE_RATE', 1.0),
+    enabled=getattr(settings, 'CACHEWRAP_METRICS', True),
+)
+
+# values that pickle to more than this many bytes are compressed
+COMPRESS_THRESHOLD = getattr(settings, 'CACHEWRAP_COMPRESS_THRESHOLD', 100*1024)
+# and split into chunks of at most this many bytes, below the 1MB item
+# limit of memcached
+ITEM_LIMIT = getattr(settings, 'CACHEWRAP_ITEM_LIMIT', 1000*1000)
+# values that are larger than this when compressed are not stored
+MAX_VALUE_SIZE = getattr(settings, 'CACHEWRAP_MAX_VALUE_SIZE', 32*1024*1024)
+
+class _ValueTooLarge(Exception):
+    pass
+
+class _NotSerializable(Exception):
+    pass
+
+class _Compressed(object):
+    '''
+    Stored in place of a value that was pickled and compressed.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+class _Pickled(object):
+    '''
+    Stored in place of a value that was pickled, but is too small to be
+    compressed, so that the cache doesn't pickle it again.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+class _Serialized(object):
+    '''
+    Stored in place of a value that was serialized by the `serializer` of
+    its function.
+    '''
+    def __init__(self, data):
+        self.data = data
+
+class _Chunked(object):
+    '''
+    Stored in place of a value that was pickled, compressed and split into
+    chunks under their own keys.  The version tells the chunks of different
+    writes apart and the checksum catches chunks that were evicted.
+    '''
+    def __init__(self, version, count, length, checksum):
+        self.version = version
+        self.count = count
+        self.length = length
+        self.checksum = checksum
+
+    def chunk_keys(self):
+        return [u'chunk.{version}.{n}'.format(version=self.version, n=n) for n in range(self.count)]
+
+def _pack(key, obj, serializer=None):
+    '''
+    Returns the cache entries to store (last_updated, value) under key,
+    with the value compressed or split into chunks when it is large, and
+    the serialized size of the value.  Raises _ValueTooLarge for values over
+    MAX_VALUE_SIZE.  The value is serialized with serializer.dumps when a
+    serializer is given, and isn't compressed again if the serializer says
+    it is COMPRESSED.  Raises _NotSerializable if the serializer fails, as
+    what the cache stored instead couldn't be read back with it.  Small
+    values are stored as the pickle made to measure them, so they aren't
+    pickled twice.
+    '''
+    last_updated, value = obj
+    if serializer is not None:
+        try:
+            data = serializer.dumps(value)
+        except Exception as e:
+            raise _NotSerializable(key, e)
+    else:
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # let the cache raise what it would have
+            return {key: obj}, None
+    size = len(data)
+    if size <= COMPRESS_THRESHOLD:
+        if serializer is None:
+            return {key: (last_updated, _Pickled(data))}, size
+        return {key: (last_updated, _Serialized(data))}, size
+    if not getattr(serializer, 'COMPRESSED', False):
+        data = zlib.compress(data)
+    if len(data) > MAX_VALUE_SIZE:
+        raise _ValueTooLarge(key, len(data))
+    if len(data) <= ITEM_LIMIT:
+        return {key: (last_updated, _Compressed(data))}, size
+    chunks = [data[i:i+ITEM_LIMIT] for i in range(0, len(data), ITEM_LIMIT)]
+    head = _Chunked(uuid.uuid4().hex, len(chunks), len(data), zlib.adler32(data))
+    entries = dict(zip(head.chunk_keys(), chunks))
+    entries[key] = (last_updated, head)
+    return entries, size
+
+def _unpack(obj, serializer=None):
+    '''
+    Returns (last_updated, value) from what _pack stored, or None if it is
+    missing or incomplete.  Values stored with another serializer than the
+    one given are treated as missing.
+    '''
+    return _unpack_sized(obj, serializer)[0]
+
+def _unpack_sized(obj, serializer=None):
+    '''
+    Returns what _unpack does and the size of the serialized value, which
+    is None for values the cache pickled itself.
+    '''
+    if obj is None:
+        return None, None
+    last_updated, value = obj
+    if isinstance(value, (_Pickled, _Serialized, _Compressed)):
+        data = value.data
+    elif isinstance(value, _Chunked):
+        keys = value.chunk_keys()
+        found = cache.get_many(keys)
+        if len(found) != len(keys):
+            return None, None
+        data = ''.join(found[key] for key in keys)
+        if len(data) != value.length or zlib.adler32(data) != value.checksum:
+            return None, None
+    elif serializer is None:
+        return obj, None
+    else:
+        return None, None
+    try:
+        if serializer is None:
+            if isinstance(value, _Serialized):
+                return None, None
+            if not isinstance(value, _Pickled):
+                data = zlib.decompress(data)
+            return (last_updated, pickle.loads(data)), len(data)
+        if isinstance(value, _Pickled):
+            return None, None
+        if not isinstance(value, _Serialized) and not getattr(serializer, 'COMPRESSED', False):
+            data = zlib.decompress(data)
+        return (last_updated, serializer.loads(data)), len(data)
+    except Exception:
+        logging.warning("Couldn't read a cached value, it may have been written with another serializer",
+                        exc_info=True)
+        return None, None
+
+def _cache_get(key, serializer=None):
+    return _unpack(cache.get(key), serializer)
+
+def _cache_get_sized(key, serializer=None):
+    return _unpack_sized(cache.get(key), serializer)
+
+def _cache_set(key, obj, timeout, serializer=None):
+    '''
+    Stores obj under key as _pack makes it, and returns its serialized size.
+    '''
+    entries, size = _pack(key, obj, serializer)
+    if len(entries) == 1:
+        cache.set(key, entries[key], timeout)
+    else:
+        cache.set_many(entries, timeout)
+    return size
+
+def _local_set(local_store, key, obj, timeout, size=None):
+    '''
+    Stores obj, a (last_updated, value) pair, in local_store for no longer
+    than the shared cache keeps it, which is timeout from last_updated.
+    '''
+    if timeout is not None:
+        timeout -= time.time() - obj[0]
+        if timeout <= 0:
+            return
+    local_store.set(key, obj, timeout, size)
+
+# how long a generation read from the cache is trusted by local caching
+GENERATION_STALENESS = getattr(settings, 'CACHEWRAP_GENERATION_STALENESS', 5)
+
 
-def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None):
+def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None, local=False,
+              single_flight=False, lock_timeout=30, wait_timeout=10, refresh_ahead=None, refresh_limit=2,
+              serializer=None):
     """
     A decorator that uses the name of the function, combined with the values
     of arguments listed in `key_args` to store and retrieve objects in the
@@ -45,10 +312,59 @@ def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None
             given a generation number that expires the cache if the
             generation has passed (i.e., all data on the same objects
             with the same common identifier can be "expired" and re-
-            fetched).
+            fetched).  Can be a list of fields for values that depend on
+            several objects, and expire when any of their generations
+            passes.  All the generations are read with one `get_many`.
         update_for_func -- update the key for the given function, but never
             short-circuit the function call. useful for calls that
             update data where the updated data is returned.
+        local -- True to also keep values in `local_cache`, in this process,
+            or a LocalCache to use instead.  Values are then shared between
+            callers and must not be changed.  The generation is read from
+            the cache at most every GENERATION_STALENESS seconds, so
+            `increment_generation` in another process can take that long
+            to take effect here.
+        single_flight -- protect the function from stampedes when a key
+            expires or its generation changes.  Concurrent misses in one
+            process wait for a single call, and across processes a lock
+            key in the cache lets one worker call the function while the
+            others get the previous value, which is kept for `timeout`
+            seconds more under a key without the generation, or wait for
+            the new one.
+        lock_timeout -- how long the lock of `single_flight` is held at
+            most, in seconds.
+        wait_timeout -- how long `single_flight` waits for another call
+            before calling the function itself, in seconds.
+        refresh_ahead -- the part of `timeout`, e.g. 0.8, after which a
+            value that is still being read is recomputed in the background
+            with the arguments of the last call, so callers don't wait for
+            it when it expires.  Keys not read for `timeout` seconds are
+            dropped.
+        refresh_limit -- how many background recomputations of the function
+            can run at the same time.
+        serializer -- an object with `dumps` and `loads` to store values
+            with instead of pickle, e.g. `visutils.data.codec` for the
+            trees of `xml2struct` and `objectify_tree`.  If it has a true
+            COMPRESSED attribute large values aren't compressed again.
+
+    Hits, misses, forced calls, failed and oversize sets, and histograms of
+    cache read time, compute time and value size are kept per function in
+    `metrics`.
+
+    The decorated function gets a `many` method that takes a list of
+    argument sets and returns the values for all of them, with one
+    `get_many` for the generations, one for the values and one `set_many`
+    for the values that had to be computed, e.g.:
+
+        fetch.many([(1,), (2,), {'id': 3, 'force': True}])
+
+    Pass threads=n to `many` to compute the misses on n threads.
+
+    It also gets a `submit` method that runs the call on a thread pool and
+    returns a Pending at once, so that event driven code doesn't block on
+    the cache or the function.  Concurrent submits with the same key
+    arguments share one call, unless they are forced or update_for_func is
+    set.
 
     !WARNING! Because the decorator relies so heavily on function names, its current
     programming does not support using other decorators along with
@@ -58,18 +374,38 @@ def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None
     to the one with multiple decorators.
     """
 
+    local_store = local_cache if local is True else (local or None)
+
     def inner(func):
+        # the signature is only looked up once, here
+        function_name = (update_for_func and update_for_func.func_name) or func.func_name
+        param_getters = None
+        if key_args is not None:
+            param_getters = [_param_getter(func, label) for label in key_args]
+        generations = [generation] if isinstance(generation, basestring) else list(generation or ())
+        generation_getters = [(name, _param_getter(func, name)) for name in generations]
+        metrics_name = u'{module}.{name}'.format(module=func.__module__, name=func.func_name)
+
         def wrapper(*args, **kwargs):
             # 'generation' remains constant throughout all cached functions,
             # but its corresponding value is common to everything that should
             # be refreshed when the cache for that generation is cleared.
             gen = None
-            if generation:
-                generation_key = extract_param_by_name(func, args, kwargs, generation)
-                gen = get_generation(generation, generation_key)
+            if len(generation_getters) == 1:
+                name, get = generation_getters[0]
+                if local_store is not None:
+                    gen = _get_local_generation(name, get(args, kwargs))
+                else:
+                    gen = get_generation(name, get(args, kwargs))
+            elif generation_getters:
+                tags = [(name, get(args, kwargs)) for name, get in generation_getters]
+                if local_store is not None:
+                    found = _get_local_generations(tags)
+                else:
+                    found = get_generations(tags)
+                gen = _combine_generations(tags, found)
 
-            function_name = (update_for_func and update_for_func.func_name) or func.func_name
-            params = (extract_param_by_name(func, args, kwargs, label) for label in key_args)
+            params = [get(args, kwargs) for get in param_getters]
             key = _make_cache_key(function_name, params, gen)
 
             # If the function has a force parameter, we skip any attempt to get an old object from the cache,
@@ -77,13 +413,47 @@ def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None
             is_globally_cleared = globals().get('force_clear_cache', False)
             force = ('force' in kwargs.keys() and kwargs['force']) or is_globally_cleared
 
-            if not update_for_func and not force:
-                obj = cache.get(key)
+            stale_key = None
+            if single_flight:
+                stale_key = u'stale.' + _make_cache_key(function_name, params)
+            call = lambda: store(key, stale_key, args, kwargs)
+
+            if update_for_func:
+                metrics.incr(metrics_name, 'updates')
+            elif force:
+                metrics.incr(metrics_name, 'forced')
+            else:
+                timed = metrics.sample()
+                if timed:
+                    started = time.time()
+                obj = None
+                if local_store is not None:
+                    obj = local_store.get(key)
+                if obj is None:
+                    obj, size = _cache_get_sized(key, serializer)
+                    if obj is not None and local_store is not None:
+                        _local_set(local_store, key, obj, timeout, size)
+                if timed:
+                    metrics.observe(metrics_name, 'get_time', time.time() - started)
+                metrics.incr(metrics_name, 'misses' if obj is None else 'hits')
                 if obj is not None:
                     last_updated, value = obj
+                    if refresh_ahead and not update_for_func:
+                        _refresher.touch(wrapper, key, call, last_updated, timeout*refresh_ahead, timeout, refresh_limit)
                     update_latest_data_time(last_updated)
                     return value
 
+            if single_flight and not update_for_func and not force:
+                last_updated, value = _single_flight(key, stale_key, call, lock_timeout, wait_timeout,
+                                                     serializer)
+            else:
+                last_updated, value = call()
+            if refresh_ahead and not update_for_func:
+                _refresher.touch(wrapper, key, call, last_updated, timeout*refresh_ahead, timeout, refresh_limit)
+            update_latest_data_time(last_updated)
+            return value
+
+        def compute(args, kwargs, timed):
             last_updated = time.time()
             value = func(*args, **kwargs)
 
@@ -91,17 +461,165 @@ def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None
             # it's efficient like you might want if you're using a generator.
             if isinstance(value, types.GeneratorType):
                 value = tuple(value)
+            if timed:
+                metrics.observe(metrics_name, 'compute_time', time.time() - last_updated)
+            return last_updated, value
+
+        def store(key, stale_key, args, kwargs):
+            timed = metrics.sample()
+            last_updated, value = compute(args, kwargs, timed)
 
             # The default max storage size for memcached is 1MB.  Don't attempt
             # to store anything larger than that or we'll get errors from it.
+            size = None
             try:
-                cache.set(key, (last_updated, value), timeout)
+                size = _cache_set(key, (last_updated, value), timeout, serializer)
+                if stale_key is not None:
+                    _cache_set(stale_key, (last_updated, value), timeout*2, serializer)
+                if timed and size is not None:
+                    metrics.observe(metrics_name, 'value_size', size)
+            except _ValueTooLarge:
+                metrics.incr(metrics_name, 'oversize')
+                warnings.warn("The object brought into '{key}' is too large to cache.".format(key=key))
+            except _NotSerializable as e:
+                metrics.incr(metrics_name, 'set_failures')
+                warnings.warn("The object brought into '{key}' couldn't be serialized: {error!r}".format(
+                    key=key, error=e.args[1]))
             except:
+                metrics.incr(metrics_name, 'set_failures')
                 warnings.warn("Server error from memcached when setting cache. "
                     "Was the object brought into '{key}' too large?".format(key=key))
+            if local_store is not None:
+                _local_set(local_store, key, (last_updated, value), timeout, size)
+            return last_updated, value
+
+        def many(argsets, threads=None):
+            calls = [_split_argset(argset) for argset in argsets]
+
+            gens = [None] * len(calls)
+            if generation_getters:
+                call_tags = [[(name, get(args, kwargs)) for name, get in generation_getters]
+                             for args, kwargs in calls]
+                all_tags = [tag for tags in call_tags for tag in tags]
+                if local_store is not None:
+                    found = _get_local_generations(all_tags)
+                else:
+                    found = get_generations(all_tags)
+                gens = [_combine_generations(tags, found) for tags in call_tags]
+
+            keys = []
+            for (args, kwargs), gen in zip(calls, gens):
+                params = [get(args, kwargs) for get in param_getters]
+                keys.append(_make_cache_key(function_name, params, gen))
+
+            is_globally_cleared = globals().get('force_clear_cache', False)
+            forced = set(key for key, (args, kwargs) in zip(keys, calls) if kwargs.get('force'))
+            found = {}
+            timed = metrics.sample()
+            if update_for_func:
+                metrics.incr(metrics_name, 'updates', len(calls))
+            elif is_globally_cleared:
+                metrics.incr(metrics_name, 'forced', len(calls))
+            else:
+                if timed:
+                    started = time.time()
+                wanted = [key for key in set(keys) if key not in forced]
+                if local_store is not None:
+                    for key in wanted:
+                        obj = local_store.get(key)
+                        if obj is not None:
+                            found[key] = obj
+                    wanted = [key for key in wanted if key not in found]
+                if wanted:
+                    fetched, sizes = {}, {}
+                    for key, obj in cache.get_many(wanted).items():
+                        obj, sizes[key] = _unpack_sized(obj, serializer)
+                        if obj is not None:
+                            fetched[key] = obj
+                    if local_store is not None:
+                        for key, obj in fetched.items():
+                            _local_set(local_store, key, obj, timeout, sizes[key])
+                    found.update(fetched)
+                if timed:
+                    metrics.observe(metrics_name, 'get_time', time.time() - started)
+
+            # the same key may be asked for more than once, but every update
+            # is applied, as its other arguments can differ
+            misses, forced_misses = [], 0
+            for key, (args, kwargs) in zip(keys, calls):
+                if update_for_func:
+                    misses.append((key, args, kwargs))
+                elif key not in found or (key in forced and kwargs.get('force')):
+                    found[key] = None
+                    if key in forced:
+                        forced_misses += 1
+                        forced.discard(key)
+                    misses.append((key, args, kwargs))
+            if not update_for_func and not is_globally_cleared:
+                metrics.incr(metrics_name, 'hits', len(calls) - len(misses))
+                metrics.incr(metrics_name, 'misses', len(misses) - forced_misses)
+                metrics.incr(metrics_name, 'forced', forced_misses)
+
+            def compute_miss(miss):
+                key, args, kwargs = miss
+                return key, compute(args, kwargs, timed)
+
+            if threads and len(misses) > 1:
+                pool = ThreadPool(min(threads, len(misses)))
+                try:
+                    computed = pool.map(compute_miss, misses)
+                finally:
+                    pool.close()
+            else:
+                computed = map(compute_miss, misses)
+
+            if computed:
+                entries, sizes = {}, {}
+                for key, obj in computed:
+                    try:
+                        packed, size = _pack(key, obj, serializer)
+                    except _ValueTooLarge:
+                        metrics.incr(metrics_name, 'oversize')
+                        warnings.warn("The object brought into '{key}' is too large to cache.".format(key=key))
+                        continue
+                    except _NotSerializable as e:
+                        metrics.incr(metrics_name, 'set_failures')
+                        warnings.warn("The object brought into '{key}' couldn't be serialized: {error!r}".format(
+                            key=key, error=e.args[1]))
+                        continue
+                    entries.update(packed)
+                    sizes[key] = size
+                    if timed and size is not None:
+                        metrics.observe(metrics_name, 'value_size', size)
+                try:
+                    cache.set_many(entries, timeout)
+                except:
+                    metrics.incr(metrics_name, 'set_failures')
+                    warnings.warn("Server error from memcached when setting cache. "
+                        "Was one of the objects brought into {keys} too large?".format(keys=[key for key, obj in computed]))
+                for key, obj in computed:
+                    found[key] = obj
+                    if local_store is not None:
+                        _local_set(local_store, key, obj, timeout, sizes.get(key))
+
+            if update_for_func:
+                objs = [obj for key, obj in computed]
+            else:
+                objs = [found[key] for key in keys]
+            values = []
+            for last_updated, value in objs:
+                update_latest_data_time(last_updated)
+                values.append(value)
+            return values
+
+        def submit(*args, **kwargs):
+            # only plain reads are merged, forced calls and updates all run
+            merge_key = None
+            if not (update_for_func or kwargs.get('force') or globals().get('force_clear_cache', False)):
+                params = [get(args, kwargs) for get in param_getters]
+                merge_key = _make_cache_key(function_name, params)
+            return _submit(merge_key, lambda: wrapper(*args, **kwargs))
 
-            update_latest_data_time(last_updated)
-            return value
         # make old function name accessible to functions using `update_for_func`
         # instead of seeing just "wrapper" as the function name
         wrapper.func_name = func.func_name
@@ -110,9 +628,242 @@ def cachewrap(key_args=None, timeout=60*5, generation=None, update_for_func=None
         wrapper.key_args = key_args
         wrapper.timeout = timeout
         wrapper.generation = generation
+        wrapper.local = local_store
+        wrapper.serializer = serializer
+        wrapper.many = many
+        wrapper.submit = submit
         return wrapper
     return inner
 
+class _Flight(object):
+    # a call that other threads of this process are waiting for
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+# how often a worker waiting for another one's lock checks the cache
+LOCK_POLL_INTERVAL = 0.1
+
+def _single_flight(key, stale_key, call, lock_timeout, wait_timeout, serializer=None):
+    '''
+    Returns call(), or what another thread's call for the same key
+    returned if one is in progress.
+    '''
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        if flight.done.wait(wait_timeout) and flight.result is not None:
+            return flight.result
+        return call()
+    try:
+        flight.result = _locked_call(key, stale_key, call, lock_timeout, wait_timeout, serializer)
+        return flight.result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+def _locked_call(key, stale_key, call, lock_timeout, wait_timeout, serializer=None):
+    '''
+    Returns call() if this process gets the lock for key, otherwise the
+    stale value if there is one, or the value once the lock holder has
+    stored it.
+    '''
+    lock_key = u'lock.' + key
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            return call()
+        finally:
+            cache.delete(lock_key)
+    obj = _cache_get(stale_key, serializer)
+    if obj is not None:
+        return obj
+    deadline = time.time() + wait_timeout
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        obj = _cache_get(key, serializer)
+        if obj is not None:
+            return obj
+        if cache.get(lock_key) is None:
+            break
+    return call()
+
+class _RefreshEntry(object):
+    def __init__(self, group, call, refresh_after, cold_after, limit):
+        self.group = group
+        self.call = call
+        self.refresh_after = refresh_after
+        self.cold_after = cold_after
+        self.limit = limit
+        self.stored_at = 0
+        self.last_access = 0
+        self.running = False
+
+class _RefreshAhead(object):
+    '''
+    Keeps the keys of `refresh_ahead` functions that are being read, and
+    recomputes those that are getting old on a thread pool.  The threads
+    are started on first use, and again after a fork.
+    '''
+    def __init__(self, threads=4, interval=1, max_keys=10000):
+        self.threads = threads
+        self.interval = interval
+        self.max_keys = max_keys
+        self.entries = {}
+        self.running = {}
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pool = None
+
+    def touch(self, group, key, call, stored_at, refresh_after, cold_after, limit):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_keys:
+                    return
+                entry = self.entries[key] = _RefreshEntry(group, call, refresh_after, cold_after, limit)
+            entry.call = call
+            entry.last_access = time.time()
+            entry.stored_at = max(entry.stored_at, stored_at)
+            if self.pid != os.getpid():
+                self._start()
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.pool = ThreadPool(self.threads)
+        self.running = {}
+        for entry in self.entries.values():
+            entry.running = False
+        thread = threading.Thread(target=self._run, args=(self.pid,))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, pid):
+        while self.pid == pid:
+            time.sleep(self.interval)
+            self.scan()
+
+    def scan(self):
+        now, due = time.time(), []
+        with self.lock:
+            for key, entry in self.entries.items():
+                if now - entry.last_access > entry.cold_after:
+                    del self.entries[key]
+                elif not entry.running and now - entry.stored_at >= entry.refresh_after:
+                    if self.running.get(entry.group, 0) < entry.limit:
+                        entry.running = True
+                        self.running[entry.group] = self.running.get(entry.group, 0) + 1
+                        due.append(entry)
+        for entry in due:
+            self.pool.apply_async(self._refresh, (entry,))
+
+    def _refresh(self, entry):
+        try:
+            last_updated, value = entry.call()
+            entry.stored_at = last_updated
+        except Exception:
+            logging.exception("Refreshing a cached value failed")
+            # wait for another period before trying again
+            entry.stored_at = time.time()
+        finally:
+            with self.lock:
+                entry.running = False
+                self.running[entry.group] -= 1
+                if not self.running[entry.group]:
+                    del self.running[entry.group]
+
+_refresher = _RefreshAhead(
+    threads=getattr(settings, 'CACHEWRAP_REFRESH_THREADS', 4),
+    interval=getattr(settings, 'CACHEWRAP_REFRESH_INTERVAL', 1),
+    max_keys=getattr(settings, 'CACHEWRAP_REFRESH_MAX_KEYS', 10000),
+)
+
+class Pending(object):
+    '''
+    The result of a call submitted to a cachewrap function, which is
+    computed on another thread.  Callbacks added with add_done_callback
+    are called with the Pending when it is done, on that thread.
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.value = None
+        self.error = None
+
+    def ready(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        '''
+        Waits for the call and returns its value, or raises its exception.
+        '''
+        if not self._done.wait(timeout):
+            raise RuntimeError("The call didn't finish within %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, value=None, error=None):
+        self.value, self.error = value, error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.exception("A callback of a cached call failed")
+
+_pending = {}
+_pending_lock = threading.Lock()
+_submit_pool = [None, None]  # (pid, pool), made on first use and after a fork
+SUBMIT_THREADS = getattr(settings, 'CACHEWRAP_SUBMIT_THREADS', 4)
+
+def _submit(merge_key, call):
+    '''
+    Runs call on the submit pool and returns its Pending, or the Pending of
+    a call for the same merge_key that hasn't finished yet.  Calls with a
+    merge_key of None are never merged.
+    '''
+    with _pending_lock:
+        if merge_key is None:
+            pending = Pending()
+        else:
+            pending = _pending.get(merge_key)
+            if pending is not None:
+                return pending
+            pending = _pending[merge_key] = Pending()
+        if _submit_pool[0] != os.getpid():
+            _submit_pool[:] = [os.getpid(), ThreadPool(SUBMIT_THREADS)]
+        pool = _submit_pool[1]
+    pool.apply_async(_run_pending, (merge_key, pending, call))
+    return pending
+
+def _run_pending(merge_key, pending, call):
+    value, error = None, None
+    try:
+        value = call()
+    except Exception as e:
+        error = e
+    with _pending_lock:
+        if _pending.get(merge_key) is pending:
+            del _pending[merge_key]
+    pending._finish(value, error)
+
 def _get_generation_key(name, key):
     return u'generation.{name}.{key}'.format(name=name, key=key)
 
@@ -120,8 +871,54 @@ DEFAULT_GENERATION = 0
 def get_generation(name, key):
     return cache.get(_get_generation_key(name, key)) or DEFAULT_GENERATION
 
+def get_generations(tags):
+    '''
+    Returns a dict of the generations of tags, (name, key) pairs, read with
+    one get_many.
+    '''
+    generation_keys = dict((tag, _get_generation_key(*tag)) for tag in tags)
+    found = cache.get_many(generation_keys.values())
+    return dict((tag, found.get(generation_key) or DEFAULT_GENERATION)
+                for tag, generation_key in generation_keys.items())
+
+def _combine_generations(tags, found):
+    # a single generation is used as it is, so its keys stay the same
+    if len(tags) == 1:
+        return found[tags[0]]
+    return u'-'.join(unicode(found[tag]) for tag in tags)
+
+# generations read by _get_local_generation, as (generation, time read),
+# for the most recently used generation keys
+_local_generations = LRUCache(getattr(settings, 'CACHEWRAP_LOCAL_GENERATIONS', 10000))
+
+def _get_local_generation(name, key):
+    generation_key = _get_generation_key(name, key)
+    entry = _local_generations.get(generation_key)
+    now = time.time()
+    if entry is not None and now - entry[1] < GENERATION_STALENESS:
+        return entry[0]
+    gen = get_generation(name, key)
+    _local_generations.set(generation_key, (gen, now))
+    return gen
+
+def _get_local_generations(tags):
+    ret, stale = {}, []
+    now = time.time()
+    for tag in tags:
+        entry = _local_generations.get(_get_generation_key(*tag))
+        if entry is not None and now - entry[1] < GENERATION_STALENESS:
+            ret[tag] = entry[0]
+        else:
+            stale.append(tag)
+    if stale:
+        for tag, gen in get_generations(stale).items():
+            _local_generations.set(_get_generation_key(*tag), (gen, now))
+            ret[tag] = gen
+    return ret
+
 def increment_generation(name, key):
     generation_key = _get_generation_key(name, key)
+    _local_generations.delete(generation_key)
     try:
         cache.incr(generation_key)  # this is said to be very fast
     except:
@@ -130,6 +927,19 @@ def increment_generation(name, key):
         # increment function.
         cache.set(generation_key, DEFAULT_GENERATION+1)
 
+def increment_generations(tags):
+    '''
+    Expires the generations of all tags, (name, key) pairs, with one
+    set_many.  Instead of adding one, each generation is set to the current
+    time in microseconds, which is past any earlier generation, so that
+    concurrent calls can't undo each other the way a read and write could.
+    '''
+    generation_keys = [_get_generation_key(*tag) for tag in tags]
+    for generation_key in generation_keys:
+        _local_generations.delete(generation_key)
+    gen = int(time.time() * 1000000)
+    cache.set_many(dict((generation_key, gen) for generation_key in generation_keys))
+
 def update_latest_data_time(last_updated):
     """Updates the `latest_data_time` global variable."""
     global latest_data_time
@@ -140,6 +950,18 @@ def update_latest_data_time(last_updated):
     if last_updated > latest_data_time:
         latest_data_time = last_updated
 
+def _split_argset(argset):
+    '''
+    Returns (args, kwargs) for an argument set given to `many`: a dict of
+    keyword arguments, a tuple or list of positional arguments, or a single
+    positional argument.
+    '''
+    if isinstance(argset, dict):
+        return (), argset
+    if isinstance(argset, (tuple, list)):
+        return tuple(argset), {}
+    return (argset,), {}
+
 def _make_cache_key(function_name, parameters, generation=None):
     key = u'external.%s.%s' % (function_name, '-'.join(map(unicode, parameters)))
     key = key.replace(' ', '-') # spaces are not allowed in the key
@@ -205,6 +1027,41 @@ def extract_param_by_name(f, args, kwargs, param):
         else:
             raise LoggerUnknownParamException("Unknown param %s(%r) on %s", type(param), param, f.__name__)
 
+def _param_getter(f, param):
+    '''
+    Returns a function of (args, kwargs) that finds the value of param the
+    same way as extract_param_by_name, with the signature of f looked up
+    only once.
+    '''
+    argspec = inspect.getargspec(f)
+    if param not in argspec.args:
+        def get(args, kwargs):
+            if param in kwargs:
+                return kwargs[param]
+            raise LoggerUnknownParamException("Unknown param %s(%r) on %s", type(param), param, f.__name__)
+        return get
+
+    param_index = argspec.args.index(param)
+    defaults = argspec.defaults or ()
+    # argsec.defaults holds the values for the LAST entries of argspec.args
+    defaults_index = param_index - len(argspec.args) + len(defaults)
+    if 0 <= defaults_index < len(defaults):
+        default = defaults[defaults_index]
+        def get(args, kwargs):
+            if param in kwargs:
+                return kwargs[param]
+            if len(args) > param_index:
+                return args[param_index]
+            return default
+    else:
+        def get(args, kwargs):
+            if param in kwargs:
+                return kwargs[param]
+            if len(args) > param_index:
+                return args[param_index]
+            raise LoggerBadCallerParametersException("Caller didn't provide a required positional parameter '%s' at index %d", param, param_index)
+    return get
+
 class LoggerUnknownParamException(Exception):
     pass
 
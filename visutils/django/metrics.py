@@ -0,0 +1,139 @@
+# encoding=utf-8
+import bisect
+import logging
+import random
+import threading
+
+# bucket bounds that double from 1 microsecond to about 17 minutes
+TIME_BOUNDS = [1e-6 * 2 ** i for i in range(31)]
+# and from 64 bytes to 128MB
+SIZE_BOUNDS = [64 * 2 ** i for i in range(22)]
+
+class Histogram(object):
+    '''
+    Counts observed values in buckets with the given upper bounds, and
+    keeps their count, sum, min and max.  Percentiles are estimated as the
+    upper bound of the bucket they fall in.
+    '''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / float(self.count) if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+class MetricsRegistry(object):
+    '''
+    Counters and histograms by name, for each of a set of functions.
+
+    Counters are always counted.  Histograms are only fed for the share of
+    calls given by sample_rate, which callers check with sample() before
+    measuring, so that timing doesn't add to every call.  Exporters added
+    with add_exporter are called with a snapshot on export().
+    '''
+    def __init__(self, histograms=None, sample_rate=1.0, enabled=True):
+        self.histogram_bounds = dict(histograms or {})
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self.exporters = []
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def _metrics(self, function):
+        metrics = self._functions.get(function)
+        if metrics is None:
+            metrics = self._functions.setdefault(function, ({}, {}))
+        return metrics
+
+    def sample(self):
+        return self.enabled and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def incr(self, function, counter, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            counters = self._metrics(function)[0]
+            counters[counter] = counters.get(counter, 0) + n
+
+    def observe(self, function, histogram, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histograms = self._metrics(function)[1]
+            if histogram not in histograms:
+                histograms[histogram] = Histogram(self.histogram_bounds.get(histogram, TIME_BOUNDS))
+            histograms[histogram].observe(value)
+
+    def snapshot(self, reset=False):
+        '''
+        Returns {function: {'counters': {...}, 'histograms': {...}}}.
+        '''
+        with self._lock:
+            ret = {}
+            for function, (counters, histograms) in self._functions.items():
+                ret[function] = {
+                    'counters': dict(counters),
+                    'histograms': dict((name, h.snapshot()) for name, h in histograms.items()),
+                }
+            if reset:
+                self._functions = {}
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._functions = {}
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self.exporters.remove(exporter)
+
+    def export(self, reset=False):
+        '''
+        Calls every exporter with a snapshot, and returns it.  Errors in an
+        exporter are logged and don't stop the others.
+        '''
+        snapshot = self.snapshot(reset=reset)
+        for exporter in self.exporters:
+            try:
+                exporter(snapshot)
+            except Exception:
+                logging.exception("Exporting metrics failed")
+        return snapshot
@@ -0,0 +1,85 @@
+# encoding=utf-8
+'''
+Icelandic collation that doesn't depend on the OS locale.
+
+Strings are turned into sort keys with three translation tables, one for
+each level of comparison: the letter, then accents on letters that aren't
+letters of their own in Icelandic (e.g. à, ä, ø), then case.  Letters are
+ordered as in the Icelandic alphabet, a á b c d ð e é f g h i í j k l m n
+o ó p q r s t u ú v w x y ý z þ æ ö, with ä sorted as æ and ø as ö.
+Spaces and punctuation come before digits and digits before letters.
+The tables cover Latin-1 and Latin Extended-A and B, characters above that
+are compared by code point after all of them.
+'''
+import unicodedata
+from visutils.data.lru import LRUCache
+
+_ALPHABET = u'aábcdðeéfghiíjklmnoópqrstuúvwxyýzþæöå'
+# letters sorted as an accented variant of another letter
+_VARIANTS = {u'ä': u'æ', u'ø': u'ö', u'đ': u'd', u'ł': u'l', u'ı': u'i'}
+_TABLE_SIZE = 0x250
+
+def _build_tables():
+    symbols, letters, other_letters = [], {}, []
+    for code in range(_TABLE_SIZE):
+        char = unichr(code)
+        lower = char.lower()
+        if not char.isalpha():
+            if not char.isdigit() or not u'0' <= char <= u'9':
+                symbols.append(char)
+            continue
+        if lower in _ALPHABET:
+            base, marks = lower, u''
+        elif lower in _VARIANTS:
+            base, marks = _VARIANTS[lower], lower
+        else:
+            decomposed = unicodedata.normalize('NFD', lower)
+            base, marks = decomposed[0], decomposed[1:]
+            if base not in _ALPHABET:
+                base, marks = lower, u''
+                if lower not in other_letters:
+                    other_letters.append(lower)
+        letters[char] = (base, marks, char != lower)
+
+    primary = {}
+    for char in symbols + list(u'0123456789') + list(_ALPHABET) + other_letters:
+        primary.setdefault(char, unichr(len(primary) + 1))
+    accents = sorted(set(marks for base, marks, upper in letters.values()))
+    secondary = dict((marks, unichr(i + 1)) for i, marks in enumerate(accents))
+
+    tables = ({}, {}, {})
+    for code in range(_TABLE_SIZE):
+        char = unichr(code)
+        base, marks, upper = letters.get(char, (char, u'', False))
+        tables[0][code] = primary[base]
+        tables[1][code] = secondary[marks]
+        tables[2][code] = u'\x02' if upper else u'\x01'
+    return tables
+
+_PRIMARY, _SECONDARY, _TERTIARY = _build_tables()
+
+_keys = LRUCache(8192)
+
+def collation_key(string):
+    '''
+    Returns a key that sorts string in Icelandic order.  Only strings with
+    the same text get equal keys, so ties are as rare as with strcoll.
+    '''
+    key = _keys.get(string)
+    if key is None:
+        text = string
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        text = unicodedata.normalize('NFC', text)
+        key = u'\x00'.join((text.translate(_PRIMARY),
+                            text.translate(_SECONDARY),
+                            text.translate(_TERTIARY)))
+        _keys.set(string, key)
+    return key
+
+def collate(string1, string2):
+    '''
+    Compares two strings in Icelandic order, for use in place of
+    locale.strcoll.
+    '''
+    return cmp(collation_key(string1), collation_key(string2))